@@ -30,34 +30,414 @@
 # In[1]:
 
 
+import contextlib
+import datetime
+import functools
+import hashlib
+import http.server
+import importlib
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.error
+import urllib.request
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 
+
+
+class LazyModule(types.ModuleType):
+    # stands in for a module until the first attribute access, which imports it
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    # nothing is imported before the module is used, not even its parent package, so runs that draw no charts don't
+    # pay for importing plotly
+    return sys.modules.get(name) or LazyModule(name)
+
+
 # visualization
-import plotly.graph_objects as go
-import plotly.tools as tls
-import plotly.offline as py
+go = lazy_import('plotly.graph_objects')
+py = lazy_import('plotly.offline')
 
 
 # In[2]:
 
 
+# opt-in profiling of the loads, transformations and plots
+# With PROFILE=1, every decorated call records wall time, CPU time, peak memory (tracemalloc, net of what was allocated
+# before the call) and rows in / out. Nested calls are recorded too, with their depth.
+# Each thread has its own stack of open calls; memory is traced for the whole process, so the peaks of calls running
+# at the same time in different threads include each other's allocations.
+PROFILE = os.environ.get('PROFILE') == '1'
+PROFILE_DIR = 'profiles'
+profile_records = []
+profile_state = threading.local()
+
+
+def profile_stack():
+    if not hasattr(profile_state, 'stack'):
+        profile_state.stack = []
+    return profile_state.stack
+
+
+def count_rows(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, tuple) and hasattr(value, 'df'):
+        return len(value.df)
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return sum(len(i) for i in value if isinstance(i, pd.DataFrame))
+    return None
+
+
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not PROFILE:
+            return function(*args, **kwargs)
+
+        # run_stage(stage, ...) is recorded under the name of the stage, and calls for one source or table, e.g.
+        # load('testing'), under its name
+        name = function.__name__
+        if args and callable(args[0]):
+            name += ':' + args[0].__name__
+        elif args and isinstance(args[0], str):
+            name += ':' + args[0]
+        stack = profile_stack()
+        stage_input = next((i for i in args if count_rows(i) is not None), None)
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        record = {'name': name, 'depth': len(stack), 'started': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'peak': 0, 'memory_before': tracemalloc.get_traced_memory()[0]}
+        stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            record['peak'] = max(record['peak'], tracemalloc.get_traced_memory()[1])
+            stack.pop()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], record['peak'])
+            tracemalloc.reset_peak()
+
+        profile_records.append({'name': name, 'depth': record['depth'], 'started': record['started'],
+                                'wall_seconds': wall, 'cpu_seconds': cpu,
+                                'peak_mb': (record['peak'] - record['memory_before']) / 2**20,
+                                'rows_in': count_rows(stage_input) if stage_input is not None else None,
+                                'rows_out': count_rows(result)})
+        return result
+    return wrapper
+
+
+def write_profile_report(profile_dir=PROFILE_DIR):
+    # one JSON and one CSV file per run
+    os.makedirs(profile_dir, exist_ok=True)
+    run = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    report = pd.DataFrame(profile_records, columns=['name', 'depth', 'started', 'wall_seconds', 'cpu_seconds', 'peak_mb', 'rows_in', 'rows_out'])
+    report.to_csv(os.path.join(profile_dir, 'profile-%s.csv' % run), index=False)
+    with open(os.path.join(profile_dir, 'profile-%s.json' % run), 'w') as f:
+        json.dump({'run': run, 'pandas': pd.__version__, 'numpy': np.__version__, 'records': profile_records}, f, indent=1)
+    return report
+
+
+# fingerprints of values, used in the keys of the caches
+# Arrays and frames are hashed in full, as their repr leaves out the middle of long ones.
+StageResult = namedtuple('StageResult', ['key', 'df'])
+
+
+def value_fingerprint(value):
+    if isinstance(value, StageResult):
+        return value.key
+    if isinstance(value, pd.DataFrame):
+        hashes = pd.util.hash_pandas_object(value, index=False).to_numpy()
+        return hashlib.sha1(hashes.tobytes() + repr(list(zip(value.columns, value.dtypes.astype(str)))).encode('utf-8')).hexdigest()
+    if isinstance(value, (pd.Series, pd.Index)):
+        return value_fingerprint(value.to_frame(index=False) if isinstance(value, pd.Index) else value.to_frame())
+    if isinstance(value, np.ndarray):
+        # the bytes of an object array are pointers, so strings and other objects are hashed by value
+        data = pd.util.hash_array(value.ravel()) if value.dtype == object else value
+        return hashlib.sha1(data.tobytes() + (str(value.dtype) + str(value.shape)).encode('utf-8')).hexdigest()
+    if isinstance(value, dict):
+        return repr([(key, value_fingerprint(value[key])) for key in sorted(value)])
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value_fingerprint(i) for i in value))
+    if isinstance(value, (list, tuple)):
+        return repr([value_fingerprint(i) for i in value])
+    return repr(value)
+
+
+# local cache for the data files
+# Each file is kept on disk as parquet (pickle if pyarrow is not installed) and revalidated with ETag / Last-Modified,
+# so unchanged files are not downloaded and parsed again. If the source can't be reached the cached copy is used.
+CACHE_DIR = 'data_cache'
+cache_stats = {'hits': 0, 'misses': 0, 'offline_hits': 0, 'bytes_downloaded': 0, 'bytes_saved': 0}
+cache_stats_lock = threading.Lock()
+
+
+def update_cache_stats(**counts):
+    with cache_stats_lock:
+        for key, value in counts.items():
+            cache_stats[key] += value
+
+
+def cache_paths(url, cache_dir=CACHE_DIR, **read_csv_kwargs):
+    key = hashlib.sha1((url + value_fingerprint(read_csv_kwargs)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, key + '.json'), os.path.join(cache_dir, key)
+
+
+def write_cached_frame(df, data_path):
+    try:
+        df.to_parquet(data_path + '.parquet')
+        return data_path + '.parquet'
+    except ImportError:
+        df.to_pickle(data_path + '.pkl')
+        return data_path + '.pkl'
+
+
+def read_cached_frame(file_name):
+    if file_name.endswith('.parquet'):
+        return pd.read_parquet(file_name)
+    return pd.read_pickle(file_name)
+
+
+def open_url(request, timeout=60, retries=2, backoff=1.0):
+    # Retry connection errors, timeouts and server errors; anything else (incl. 304) goes back to the caller
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == retries:
+                raise
+        except (urllib.error.URLError, TimeoutError, OSError):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def apply_schema(df, schema):
+    # schema maps columns to 'category', 'integer' (narrowest integer type that fits), 'float' (float32) or a dtype;
+    # '*' applies to every column not listed. Integer columns with missing values are kept as float.
+    for column in df.columns:
+        dtype = schema.get(column, schema.get('*'))
+        if dtype is None or pd.api.types.is_datetime64_any_dtype(df[column]) or df[column].dtype == dtype:
+            continue
+        if dtype in ('integer', 'float'):
+            df[column] = pd.to_numeric(df[column], downcast=dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def row_filter(df, where):
+    # where maps columns to a list of values to keep or to a (lowest, highest) tuple, None meaning open ended
+    mask = np.ones(len(df), dtype=bool)
+    for column, condition in where.items():
+        values = df[column]
+        if isinstance(condition, tuple):
+            lowest, highest = condition
+            if lowest is not None:
+                mask &= (values >= lowest).to_numpy()
+            if highest is not None:
+                mask &= (values <= highest).to_numpy()
+        else:
+            if pd.api.types.is_datetime64_any_dtype(values):
+                condition = pd.to_datetime(list(condition))
+            mask &= values.isin(condition).to_numpy()
+    return mask
+
+
+def read_csv_filtered(file, columns=None, where=None, chunksize=250000, **read_csv_kwargs):
+    # Only the listed columns are parsed, and with a filter the file is read in chunks dropping the rows that don't match
+    if columns is not None:
+        columns = set(columns)
+        read_csv_kwargs['usecols'] = lambda column: column in columns
+    if not where:
+        return pd.read_csv(file, **read_csv_kwargs)
+
+    chunks = [chunk[row_filter(chunk, where)] for chunk in pd.read_csv(file, chunksize=chunksize, **read_csv_kwargs)]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_csv_cached(url, cache_dir=CACHE_DIR, timeout=60, retries=2, schema=None, columns=None, where=None, **read_csv_kwargs):
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path, data_path = cache_paths(url, cache_dir, schema=schema, columns=columns, where=where, **read_csv_kwargs)
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if not os.path.exists(meta['file']):
+            meta = None
+
+    request = urllib.request.Request(url)
+    if meta is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        body, headers = open_url(request, timeout=timeout, retries=retries)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and meta is not None:
+            update_cache_stats(hits=1, bytes_saved=meta['size'])
+            return read_cached_frame(meta['file'])
+        # a server that keeps failing is treated like one that can't be reached
+        if e.code < 500 or meta is None:
+            raise
+        update_cache_stats(offline_hits=1, bytes_saved=meta['size'])
+        return read_cached_frame(meta['file'])
+    except (urllib.error.URLError, TimeoutError, OSError):
+        if meta is None:
+            raise
+        update_cache_stats(offline_hits=1, bytes_saved=meta['size'])
+        return read_cached_frame(meta['file'])
+
+    if schema:
+        # categoricals are built by the parser, numbers are narrowed right after parsing
+        read_csv_kwargs = dict(read_csv_kwargs, dtype={column: 'category' for column, dtype in schema.items() if dtype == 'category'})
+    df = read_csv_filtered(io.BytesIO(body), columns=columns, where=where, **read_csv_kwargs)
+    if schema:
+        # chunks with different categories are concatenated as strings, this turns them back into categoricals
+        df = apply_schema(df, schema)
+    file_name = write_cached_frame(df, data_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                   'size': len(body), 'file': file_name}, f)
+
+    update_cache_stats(misses=1, bytes_downloaded=len(body))
+    return df
+
+
+# concurrent loading of the data files
+# All files are downloaded and parsed in a thread pool, so the load takes about as long as the slowest file.
+DATA_SOURCES = {
+    'cases_by_age': "https://data.london.gov.uk/download/coronavirus--covid-19--cases/d15e692d-5e58-4b6e-80f2-78df6f8b148b/phe_cases_age_london.csv",
+    'vaccines_by_age': "https://data.london.gov.uk/download/coronavirus--covid-19--cases/ae4d5fc9-5448-49a6-810f-910f7cbc9fd2/phe_vaccines_age_london_boroughs.csv",
+    'admissions_by_age': "https://data.london.gov.uk/download/coronavirus--covid-19--cases/ad037e43-0f09-473a-8d62-b576de380af6/phe_healthcare_admissions_age.csv",
+    'restrictions': "https://data.london.gov.uk/download/covid-19-restrictions-timeseries/ae1b5b4c-3b5c-471f-b3e5-ba4fbc3eced9/restrictions_daily.csv",
+    'testing': "https://api.coronavirus.data.gov.uk/v2/data?areaType=region&areaCode=E12000007&metric=uniquePeopleTestedBySpecimenDateRollingSum&format=csv",
+}
+
+# timeouts in seconds, per source
+SOURCE_TIMEOUTS = {'cases_by_age': 120, 'vaccines_by_age': 120, 'admissions_by_age': 60, 'restrictions': 60, 'testing': 60}
+
+# date columns, parsed to datetime64 while reading
+SOURCE_DATE_COLUMNS = {'cases_by_age': ['date'], 'vaccines_by_age': ['date'], 'admissions_by_age': ['week_ending'], 'restrictions': ['date'], 'testing': ['date']}
+
+# compact dtypes, applied while reading
+SOURCE_SCHEMAS = {
+    'cases_by_age': {'area_type': 'category', 'area_code': 'category', 'area_name': 'category', 'age_band': 'category',
+                     'cases': 'integer', 'rolling_sum': 'integer', 'population': 'integer', 'case_rate': 'float'},
+    'vaccines_by_age': {'area_code': 'category', 'area_name': 'category', 'dose': 'category', 'age_band': 'category',
+                        'new_doses': 'integer', 'cum_doses': 'integer', 'population': 'integer'},
+    'admissions_by_age': {'area_code': 'category', 'area_name': 'category', 'age': 'category', 'weekly_admissions': 'integer'},
+    # restriction flags are 0 / 1
+    'restrictions': {'*': 'integer'},
+    'testing': {'areaCode': 'category', 'areaName': 'category', 'areaType': 'category',
+                'uniquePeopleTestedBySpecimenDateRollingSum': 'integer'},
+}
+
+# columns to parse, None for all of them; the unused columns of cases and testing are skipped
+SOURCE_COLUMNS = {
+    'cases_by_age': ['area_code', 'area_name', 'date', 'age_band', 'cases', 'rolling_sum', 'population'],
+    'testing': ['areaName', 'date', 'uniquePeopleTestedBySpecimenDateRollingSum'],
+}
+
+Datasets = namedtuple('Datasets', list(DATA_SOURCES) + ['load_seconds'])
+
+
+@profiled
+def load_datasets(sources=DATA_SOURCES, timeouts=SOURCE_TIMEOUTS, retries=2, cache_dir=CACHE_DIR,
+                  date_columns=SOURCE_DATE_COLUMNS, schemas=SOURCE_SCHEMAS, columns=SOURCE_COLUMNS, filters=None):
+    # filters optionally maps sources to row filters, see row_filter()
+    filters = filters or {}
+
+    # each source has its own profile record, to show which of them is slow
+    @profiled
+    def load(name):
+        start = time.perf_counter()
+        df = read_csv_cached(sources[name], cache_dir=cache_dir, timeout=timeouts.get(name, 60), retries=retries,
+                             schema=schemas.get(name), columns=columns.get(name), where=filters.get(name),
+                             parse_dates=date_columns.get(name, False))
+        return df, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        results = dict(zip(sources, executor.map(load, sources)))
+
+    return Datasets(load_seconds={name: seconds for name, (df, seconds) in results.items()},
+                    **{name: df for name, (df, seconds) in results.items()})
+
+
+def default_dtypes(df):
+    # the frame as pd.read_csv would return it without a schema: strings for categories and dates, 64 bit numbers
+    columns = {}
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            columns[column] = df[column].astype(object)
+        elif pd.api.types.is_datetime64_any_dtype(df[column]):
+            columns[column] = df[column].dt.strftime('%Y-%m-%d')
+        elif pd.api.types.is_integer_dtype(df[column]):
+            columns[column] = df[column].astype('int64')
+        elif pd.api.types.is_float_dtype(df[column]):
+            columns[column] = df[column].astype('float64')
+        else:
+            columns[column] = df[column]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_report(**frames):
+    rows = []
+    for name, df in frames.items():
+        before = default_dtypes(df).memory_usage(deep=True).sum()
+        after = df.memory_usage(deep=True).sum()
+        rows.append({'frame': name, 'rows': len(df), 'default_mb': before / 2**20, 'compact_mb': after / 2**20,
+                     'saving': 1 - after / before})
+    return pd.DataFrame(rows).set_index('frame')
+
+
 # import data files
-cases_by_age = pd.read_csv("https://data.london.gov.uk/download/coronavirus--covid-19--cases/d15e692d-5e58-4b6e-80f2-78df6f8b148b/phe_cases_age_london.csv")
-vaccines_by_age = pd.read_csv("https://data.london.gov.uk/download/coronavirus--covid-19--cases/ae4d5fc9-5448-49a6-810f-910f7cbc9fd2/phe_vaccines_age_london_boroughs.csv")
-admissions_by_age = pd.read_csv("https://data.london.gov.uk/download/coronavirus--covid-19--cases/ad037e43-0f09-473a-8d62-b576de380af6/phe_healthcare_admissions_age.csv")
-restrictions = pd.read_csv("https://data.london.gov.uk/download/covid-19-restrictions-timeseries/ae1b5b4c-3b5c-471f-b3e5-ba4fbc3eced9/restrictions_daily.csv")
-testing = pd.read_csv("https://api.coronavirus.data.gov.uk/v2/data?areaType=region&areaCode=E12000007&metric=uniquePeopleTestedBySpecimenDateRollingSum&format=csv")
+# Note: the rows are not filtered on loading, e.g. to the week endings with filters=, as section 4 and the checks of
+# section 5 use every day of the data; benchmark_pushdown() in the appendix measures what such a filter saves.
+datasets = load_datasets()
+cases_by_age, vaccines_by_age, admissions_by_age, restrictions, testing = datasets[:5]
+
+print('Load times (seconds):', datasets.load_seconds)
+
+cache_stats
 
 
 # In[3]:
 
 
 # functions for plotting graphs
-def one_variable_graph(df_name, date_column_name, value_column_name, graph_title, xaxis_title, yaxis_title):
+# The *_figure functions build the figures, the *_graph functions build and show them.
+def one_variable_figure(df_name, date_column_name, value_column_name, graph_title, xaxis_title, yaxis_title):
     
-    df = df_name.groupby(date_column_name).sum()
-    df = df[[value_column_name]]
+    df = df_name.groupby(date_column_name)[[value_column_name]].sum()
     df = df.sort_values(date_column_name, ascending=True).sort_index()
     data = go.Bar(x=df.index, y=df[value_column_name],marker_color="Blue")
 
@@ -73,59 +453,446 @@ def one_variable_graph(df_name, date_column_name, value_column_name, graph_title
                                          zeroline=True,
                                          showline=True,)))
 
-    py.iplot(dict(data=data, layout=layout))
+    return go.Figure(data=[data], layout=layout)
 
 
-def two_variable_stacked_graph(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+@profiled
+def one_variable_graph(df_name, date_column_name, value_column_name, graph_title, xaxis_title, yaxis_title):
+    if not queue_chart(one_variable_figure, df_name, date_column_name, value_column_name, graph_title, xaxis_title, yaxis_title):
+        py.iplot(downsample_figure(one_variable_figure(df_name, date_column_name, value_column_name, graph_title, xaxis_title, yaxis_title)))
 
-    df = df_name.groupby([legend_column_name,date_column_name]).sum()
-    df = df.sort_values(date_column_name, ascending=True).sort_index()
-    df = df[[value_column_name]]
 
-    data_fig=[]
-    for i,j in enumerate(df_name.eval(legend_column_name).unique()):
-        data_fig.append('go.Bar(name="'+j+'",x=df.index.get_level_values(date_column_name), y=df.filter(like = "'+j+'", axis=0).loc[:value_column_name][value_column_name])')
-        i+=1
-    data_fig=list(map(eval, data_fig))
+def wide_by_legend(df_name, date_column_name, value_column_name, legend_column_name):
+    # one row per date, one column per legend value; missing combinations are left as NaN
+    df = df_name.groupby([date_column_name, legend_column_name], sort=True, observed=True)[value_column_name].sum().unstack(legend_column_name)
+    return df.sort_index()
+
+
+def legend_traces(df_name, date_column_name, value_column_name, legend_column_name):
+    df = wide_by_legend(df_name, date_column_name, value_column_name, legend_column_name)
+    x = df.index.to_numpy()
+    values = df.to_numpy()
+    columns = {j: i for i, j in enumerate(df.columns)}
+
+    data_fig = []
+    for j in df_name[legend_column_name].unique():
+        data_fig.append(go.Bar(name=str(j), x=x, y=values[:, columns[j]]))
+    return data_fig
+
+
+def two_variable_stacked_figure(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+
+    data_fig = legend_traces(df_name, date_column_name, value_column_name, legend_column_name)
 
     fig = go.Figure(data=data_fig)
     fig.update_layout(barmode='stack', title_text=graph_title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
-    fig.show()
+    return fig
+
+
+@profiled
+def two_variable_stacked_graph(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+    if not queue_chart(two_variable_stacked_figure, df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+        downsample_figure(two_variable_stacked_figure(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title)).show()
     
     
-def two_variable_grouped_graph(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+def two_variable_grouped_figure(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
 
-    df = df_name.groupby([legend_column_name,date_column_name]).sum()
-    df = df.sort_values(date_column_name, ascending=True).sort_index()
-    df = df[[value_column_name]]
-
-    data_fig=[]
-    for i,j in enumerate(df_name.eval(legend_column_name).unique()):
-        data_fig.append('go.Bar(name="'+j+'",x=df.index.get_level_values(date_column_name), y=df.filter(like = "'+j+'", axis=0).loc[:value_column_name][value_column_name])')
-        i+=1
-    data_fig=list(map(eval, data_fig))
+    data_fig = legend_traces(df_name, date_column_name, value_column_name, legend_column_name)
 
     fig = go.Figure(data=data_fig)
     fig.update_layout(barmode='group', title_text=graph_title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
-    fig.show()
+    return fig
+
+
+@profiled
+def two_variable_grouped_graph(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+    if not queue_chart(two_variable_grouped_figure, df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title):
+        downsample_figure(two_variable_grouped_figure(df_name, date_column_name, value_column_name, legend_column_name, graph_title, xaxis_title, yaxis_title)).show()
     
     
-def multi_value_stacked_graph(df_name, date_column_name, graph_title, xaxis_title, yaxis_title):
-    df = df_name.groupby([date_column_name]).sum()
-    df = df.sort_values(date_column_name, ascending=True).sort_index()
+def multi_value_stacked_figure(df_name, date_column_name, graph_title, xaxis_title, yaxis_title):
+    df = df_name.groupby([date_column_name]).sum().sort_index()
+    x = df.index.to_numpy()
 
-    data_fig=[]
-    for i,j in enumerate(df_name.columns):
-        if j == date_column_name:
-            continue
-        else:
-            data_fig.append('go.Bar(name="'+j+'",x=df.index, y=df["'+j+'"])')
-            i+=1
-    data_fig=list(map(eval, data_fig))
+    data_fig = []
+    for j in df.columns:
+        data_fig.append(go.Bar(name=str(j), x=x, y=df[j].to_numpy()))
 
     fig = go.Figure(data=data_fig)
     fig.update_layout(barmode='stack', title_text=graph_title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
-    fig.show()
+    return fig
+
+
+@profiled
+def multi_value_stacked_graph(df_name, date_column_name, graph_title, xaxis_title, yaxis_title):
+    if not queue_chart(multi_value_stacked_figure, df_name, date_column_name, graph_title, xaxis_title, yaxis_title):
+        downsample_figure(multi_value_stacked_figure(df_name, date_column_name, graph_title, xaxis_title, yaxis_title)).show()
+
+
+# downsampling of long traces
+# With MAX_POINTS set, every figure is cut down to at most that many points per trace before it is shown or rendered.
+# 'lttb' (largest triangle three buckets) keeps the points that shape the curve, 'minmax' keeps the lowest and the
+# highest point of each bucket. The traces of a figure share the same x values, so the points are picked on their total
+# and kept in every trace, which keeps the bars of stacked and grouped charts aligned.
+MAX_POINTS = int(os.environ.get('MAX_POINTS', 0)) or None
+DOWNSAMPLE_METHOD = os.environ.get('DOWNSAMPLE_METHOD', 'lttb')
+
+
+def lttb_indices(x, y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # first and last points are kept, the others are split into n_out - 2 buckets
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(np.int64), n)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop, next_stop = edges[i], edges[i + 1], edges[i + 2]
+        next_x, next_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        # the point making the largest triangle with the last kept point and the average of the next bucket
+        area = np.abs((x[a] - next_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(np.int64)
+    lows = [start + np.argmin(y[start:stop]) for start, stop in zip(edges[:-1], edges[1:])]
+    highs = [start + np.argmax(y[start:stop]) for start, stop in zip(edges[:-1], edges[1:])]
+    return np.unique(np.concatenate([lows, highs]))
+
+
+def downsample_figure(fig, max_points=MAX_POINTS, method=DOWNSAMPLE_METHOD, x_range=None):
+    # x_range=(start, end) zooms in; given a freshly built figure, it brings back the full detail of that part of the chart
+    if not fig.data or (max_points is None and x_range is None):
+        return fig
+    x = np.asarray(fig.data[0].x)
+    # categorical axes, such as the age bands, are left whole
+    if not (np.issubdtype(x.dtype, np.datetime64) or np.issubdtype(x.dtype, np.number)) or any(len(trace.x) != len(x) for trace in fig.data):
+        return fig
+    keep = np.arange(len(x))
+    if x_range is not None:
+        start, end = np.asarray(x_range, dtype=x.dtype)
+        keep = keep[(x >= start) & (x <= end)]
+        fig.update_xaxes(range=list(x_range))
+    if max_points is not None and len(keep) > max_points:
+        total = np.nan_to_num(np.sum([np.asarray(trace.y, dtype=float)[keep] for trace in fig.data], axis=0))
+        if method == 'lttb':
+            keep = keep[lttb_indices(x[keep].astype(np.int64).astype(float), total, max_points)]
+        elif method == 'minmax':
+            keep = keep[minmax_indices(total, max_points)]
+        else:
+            raise ValueError('Unknown downsampling method: %s' % method)
+    for trace in fig.data:
+        trace.x, trace.y = np.asarray(trace.x)[keep], np.asarray(trace.y)[keep]
+    return fig
+
+
+# functions for combining age bands into fewer buckets
+# A scheme lists the new buckets with their (lowest, highest) ages, None meaning no upper limit.
+FIVE_AGE_BANDS = {'0 - 24 years': (0, 24), '25 - 39 years': (25, 39), '40 - 54 years': (40, 54), '55 - 69 years': (55, 69), '70+ years': (70, None)}
+ADMISSIONS_AGE_BANDS = {'0 - 17 years': (0, 17), '18 - 64 years': (18, 64), '65+ years': (65, None)}
+
+
+def age_band_limits(age_band):
+    ages = [int(i) for i in re.findall(r'\d+', str(age_band))]
+    if not ages:
+        raise ValueError('Can not read the ages of age band %r' % (age_band,))
+    if '+' in str(age_band):
+        return ages[0], None
+    if str(age_band).lower().startswith('under'):
+        return 0, ages[0] - 1
+    return ages[0], ages[-1]
+
+
+def age_band_mapping(age_bands, scheme):
+    # original -> new age band table, every original band has to fit into one of the new buckets
+    mapping = {}
+    for age_band in age_bands:
+        lowest, highest = age_band_limits(age_band)
+        for new_age_band, (new_lowest, new_highest) in scheme.items():
+            if lowest >= new_lowest and (new_highest is None or (highest is not None and highest <= new_highest)):
+                mapping[age_band] = new_age_band
+                break
+        else:
+            raise ValueError('Age band %r does not fit into any of %s' % (age_band, list(scheme)))
+    return mapping
+
+
+def rebucket_age_bands(df_name, age_band_column_name, mapping, new_column_name='age_band', categories=None):
+    # The band column is factorized once and the new bands are looked up by code, so this is a single pass over the rows
+    codes, age_bands = pd.factorize(df_name[age_band_column_name])
+    categories = pd.Index(list(dict.fromkeys(mapping.values())) if categories is None else list(categories))
+
+    lookup = categories.get_indexer([mapping.get(age_band) for age_band in age_bands])
+    if (lookup == -1).any():
+        raise ValueError('No new age band for %s' % list(np.asarray(age_bands)[lookup == -1]))
+
+    new_codes = np.where(codes == -1, -1, lookup[codes])
+    return df_name.assign(**{new_column_name: pd.Categorical.from_codes(new_codes, categories=categories, ordered=True)})
+
+
+def consolidate(df_name, key_column_names, value_column_names):
+    # one row per group, sorted by the keys, keeping the dtypes of the keys and the values
+    return df_name.groupby(key_column_names, sort=True, observed=True)[value_column_names].sum().reset_index()
+
+
+# functions for converting daily data to weekly
+ONE_WEEK = np.timedelta64(7, 'D').astype('timedelta64[ns]').astype('int64')
+
+
+def week_ending_calendar(week_endings):
+    # unique, sorted week ending dates
+    return np.unique(pd.to_datetime(pd.Series(week_endings)).to_numpy('datetime64[ns]'))
+
+
+def weekly_alignment(df_name, date_column_name, week_endings, how='snapshot', key_column_names=(), value_column_names=None):
+    # how='snapshot' keeps the rows dated on a week ending, 'sum' and 'mean' aggregate the seven days up to each week ending
+    dates = df_name[date_column_name]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates)
+    dates = dates.to_numpy('datetime64[ns]').view('int64')
+    calendar = np.asarray(week_endings, dtype='datetime64[ns]').view('int64')
+
+    # position of the first week ending on or after each date
+    positions = np.searchsorted(calendar, dates, side='left')
+    week_ending = calendar[np.minimum(positions, len(calendar) - 1)]
+    in_calendar = positions < len(calendar)
+
+    if how == 'snapshot':
+        return df_name[in_calendar & (week_ending == dates)].reset_index(drop=True)
+    if how not in ('sum', 'mean'):
+        raise ValueError("how has to be 'snapshot', 'sum' or 'mean', not %r" % (how,))
+
+    in_week = in_calendar & (week_ending - dates < ONE_WEEK)
+    df = df_name[in_week].assign(**{date_column_name: week_ending[in_week].view('datetime64[ns]')})
+    key_column_names = [date_column_name] + list(key_column_names)
+    if value_column_names is None:
+        value_column_names = [i for i in df.select_dtypes('number').columns if i not in key_column_names]
+    grouped = df.groupby(key_column_names, sort=True, observed=True)[list(value_column_names)]
+    return (grouped.sum() if how == 'sum' else grouped.mean()).reset_index()
+
+
+def rolling_window(df_name, date_column_name, value_column_name, key_column_names, window=7, how='sum'):
+    # Sum or mean of the last `window` calendar days of each group, for all groups at once.
+    # Rows are sorted by group and day, and each window is the difference of two cumulative sums.
+    # Missing dates simply have no rows in the window; the mean is over the days that have a value.
+    if how not in ('sum', 'mean'):
+        raise ValueError("how has to be 'sum' or 'mean', not %r" % (how,))
+
+    groups = df_name.groupby(list(key_column_names), sort=False, observed=True).ngroup().to_numpy('int64')
+    days = df_name[date_column_name].to_numpy('datetime64[D]').astype('int64')
+    values = df_name[value_column_name]
+    if pd.api.types.is_integer_dtype(values):
+        present = np.ones(len(values), dtype=bool)
+        values = values.to_numpy('int64')
+    else:
+        values = values.to_numpy('float64')
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0.0)
+
+    order = np.lexsort((days, groups))
+    first_day = days.min() if len(days) else 0
+    position = groups[order] * (days.max() - first_day + window + 1) + (days[order] - first_day) if len(days) else days
+
+    # rows [start, end) of the sorted arrays fall in the window ending on each row's date
+    start = np.searchsorted(position, position - window + 1, side='left')
+    end = np.searchsorted(position, position, side='right')
+    sums = np.concatenate(([0], np.cumsum(values[order])))
+    result = sums[end] - sums[start]
+    if how == 'mean' or not present.all():
+        counts = np.concatenate(([0], np.cumsum(present[order])))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = np.where(counts[end] > counts[start], result, np.nan)
+            if how == 'mean':
+                result = result / (counts[end] - counts[start])
+
+    rolled = np.empty(len(result), dtype=result.dtype)
+    rolled[order] = result
+    return pd.Series(rolled, index=df_name.index, name='%s_rolling_%s_%d' % (value_column_name, how, window))
+
+
+# pipeline stages of the section 5 transformations: load -> align weekly -> project / rename -> re-band -> consolidate
+# Each stage takes a frame and parameters and returns a new frame.
+def replace_rolling_sum(df_name, window_days):
+    return df_name.assign(rolling_sum=rolling_window(df_name, 'date', 'cases', ['area_code', 'age_band'], window=window_days))
+
+
+def align_weekly(df_name, week_endings, date_column_name='date', how='snapshot', key_column_names=(), value_column_names=None):
+    return weekly_alignment(df_name, date_column_name, week_endings, how=how, key_column_names=key_column_names,
+                            value_column_names=value_column_names)
+
+
+def project_columns(df_name, columns=None, rename=None, drop_values=None, negate=None):
+    # keep and rename columns, drop rows by value (after renaming) and reverse the sign of columns
+    df = df_name if columns is None else df_name[columns]
+    if rename:
+        df = df.rename(columns=rename)
+    for column, values in (drop_values or {}).items():
+        df = df[~df[column].isin(values)]
+    if negate:
+        df = df.assign(**{column: df[column] * -1 for column in negate})
+    return df
+
+
+def reband(df_name, age_band_column_name, scheme, new_column_name='age_band'):
+    mapping = age_band_mapping(df_name[age_band_column_name].unique(), scheme)
+    return rebucket_age_bands(df_name, age_band_column_name, mapping, new_column_name, scheme)
+
+
+# memoization of the stages
+# The output of a stage is stored on disk under a key made from the stage's code (and the code of the functions it
+# calls), its parameters and the keys of its input. A stage whose code, parameters and input are unchanged is read back
+# from disk instead of being run; stages after a changed one get a new input key and are run again.
+STAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'stages')
+STAGE_CACHE_MAX_MB = 512
+STAGE_CACHE = os.environ.get('STAGE_CACHE', '1') == '1'
+stage_cache_stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+def code_fingerprint(code):
+    parts = [code.co_code, repr(code.co_names).encode('utf-8')]
+    for const in code.co_consts:
+        parts.append(code_fingerprint(const).encode('utf-8') if isinstance(const, types.CodeType) else repr(const).encode('utf-8'))
+    return hashlib.sha1(b'|'.join(parts)).hexdigest()
+
+
+def function_fingerprint(function, seen=None):
+    # the function and every function of this notebook it calls, directly or not
+    seen = set() if seen is None else seen
+    function = getattr(function, '__wrapped__', function)
+    seen.add(function.__name__)
+    parts = [function.__name__, code_fingerprint(function.__code__), repr(function.__defaults__)]
+    for name in function.__code__.co_names:
+        called = function.__globals__.get(name)
+        if callable(called) and hasattr(called, '__code__') and name not in seen:
+            parts.append(function_fingerprint(called, seen))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def load_stage(df_name):
+    # first stage of the pipeline, keyed on the content of the loaded frame
+    return StageResult(value_fingerprint(df_name), df_name)
+
+
+def evict_stage_cache(cache_dir=STAGE_CACHE_DIR, max_mb=STAGE_CACHE_MAX_MB):
+    # remove the least recently used outputs until the cache fits in max_mb
+    files = [os.path.join(cache_dir, i) for i in os.listdir(cache_dir)]
+    files = sorted(files, key=os.path.getmtime)
+    total = sum(os.path.getsize(i) for i in files)
+    while files and total > max_mb * 2**20:
+        file_name = files.pop(0)
+        total -= os.path.getsize(file_name)
+        os.remove(file_name)
+        stage_cache_stats['evicted'] += 1
+
+
+@profiled
+def run_stage(function, stage_input, cache_dir=STAGE_CACHE_DIR, **params):
+    if not isinstance(stage_input, StageResult):
+        stage_input = load_stage(stage_input)
+    key = hashlib.sha1('|'.join([function_fingerprint(function), stage_input.key, value_fingerprint(params)]).encode('utf-8')).hexdigest()
+    if not STAGE_CACHE:
+        return StageResult(key, function(stage_input.df, **params))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for file_name in (os.path.join(cache_dir, key + '.parquet'), os.path.join(cache_dir, key + '.pkl')):
+        if os.path.exists(file_name):
+            os.utime(file_name)
+            stage_cache_stats['hits'] += 1
+            return StageResult(key, read_cached_frame(file_name))
+
+    df = function(stage_input.df, **params)
+    write_cached_frame(df, os.path.join(cache_dir, key))
+    evict_stage_cache(cache_dir)
+    stage_cache_stats['misses'] += 1
+    return StageResult(key, df)
+
+
+@contextlib.contextmanager
+def stage_cache_disabled():
+    # the stages are run instead of read back, and nothing is written to the cache, e.g. while they are timed
+    global STAGE_CACHE
+    stage_cache, STAGE_CACHE = STAGE_CACHE, False
+    try:
+        yield
+    finally:
+        STAGE_CACHE = stage_cache
+
+
+# batch rendering of the charts
+# With BATCH_RENDER=1 the *_graph functions queue their charts instead of showing them, and render_charts() writes
+# them as standalone HTML and JSON figure specs, in a process pool with workers > 1. A chart is keyed on the code of its builder and on
+# its data and parameters, and is only rendered again when the key changes.
+# With SHOW_CHARTS=0 the charts are neither shown nor queued.
+BATCH_RENDER = os.environ.get('BATCH_RENDER') == '1'
+SHOW_CHARTS = os.environ.get('SHOW_CHARTS', '1') == '1'
+RENDER_DIR = 'charts'
+render_jobs = []
+
+ChartJob = namedtuple('ChartJob', ['builder', 'args'])
+
+
+def queue_chart(builder, *args):
+    # True when the chart is not to be shown now
+    if BATCH_RENDER:
+        render_jobs.append(ChartJob(builder, args))
+    return BATCH_RENDER or not SHOW_CHARTS
+
+
+def chart_key(job):
+    return hashlib.sha1('|'.join([function_fingerprint(job.builder), value_fingerprint(list(job.args)),
+                                  function_fingerprint(downsample_figure), repr((MAX_POINTS, DOWNSAMPLE_METHOD))]).encode('utf-8')).hexdigest()
+
+
+def render_chart(job, file_name):
+    # returns the wall and CPU seconds of building and of writing the chart, for the profile of the calling process
+    wall, cpu = time.perf_counter(), time.process_time()
+    fig = downsample_figure(job.builder(*job.args))
+    built = time.perf_counter(), time.process_time()
+    # the plotly library is written once next to the charts instead of into every file
+    fig.write_html(file_name + '.html', include_plotlyjs='directory')
+    fig.write_json(file_name + '.json')
+    written = time.perf_counter(), time.process_time()
+    return {'build_seconds': built[0] - wall, 'build_cpu_seconds': built[1] - cpu,
+            'write_seconds': written[0] - built[0], 'write_cpu_seconds': written[1] - built[1]}
+
+
+@profiled
+def render_charts(jobs=render_jobs, render_dir=RENDER_DIR, workers=1):
+    os.makedirs(render_dir, exist_ok=True)
+    keys = [chart_key(job) for job in jobs]
+    pending = {key: job for key, job in zip(keys, jobs) if not os.path.exists(os.path.join(render_dir, key + '.html'))}
+
+    file_names = [os.path.join(render_dir, key) for key in pending]
+    if workers == 1 or not pending:
+        timings = list(map(render_chart, pending.values(), file_names))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            timings = list(pool.map(render_chart, pending.values(), file_names))
+    timings = dict(zip(pending, timings))
+
+    # the *_graph calls only queued the charts, they are built and written here, possibly in other processes
+    if PROFILE:
+        started = datetime.datetime.now().isoformat(timespec='seconds')
+        for key, timing in timings.items():
+            job = pending[key]
+            for step in ('build', 'write'):
+                profile_records.append({'name': '%s_chart:%s' % (step, job.builder.__name__), 'depth': len(profile_stack()),
+                                        'started': started, 'wall_seconds': timing[step + '_seconds'],
+                                        'cpu_seconds': timing[step + '_cpu_seconds'], 'peak_mb': None,
+                                        'rows_in': count_rows(job.args[0]) if step == 'build' else None, 'rows_out': None})
+
+    index = [{'title': job.args[-3], 'builder': job.builder.__name__, 'key': key, 'html': key + '.html', 'json': key + '.json',
+              'rendered': key in pending, 'build_seconds': timings.get(key, {}).get('build_seconds'),
+              'write_seconds': timings.get(key, {}).get('write_seconds')} for key, job in zip(keys, jobs)]
+    with open(os.path.join(render_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return pd.DataFrame(index)
 
 
 # ### 4. A peek at the data
@@ -139,6 +906,10 @@ print('The shape of vaccines by age:', vaccines_by_age.shape)
 print('The shape of restrictions:', restrictions.shape)
 print('The shape of testing:', testing.shape)
 
+# memory used by the frames with the declared dtypes, against the default dtypes
+print(memory_report(cases_by_age=cases_by_age, admissions_by_age=admissions_by_age, vaccines_by_age=vaccines_by_age,
+                    restrictions=restrictions, testing=testing))
+
 
 # In[5]:
 
@@ -326,114 +1097,193 @@ one_variable_graph(testing, 'date', 'uniquePeopleTestedBySpecimenDateRollingSum'
 # * For restrictions dataframe: Reversing the sign of the "eat out to help out" column.
 # * For cases by age dataframe: Dropping the rows including "unassigned" as age_band.
 
-# ##### Cases by age
+# ##### Incremental refresh
+
+# The sources are daily time series that mostly grow at the end. With INCREMENTAL_REFRESH=1 each weekly table below is stored on disk together with the last date taken from its source, so that a refresh only runs the rows from a few days before that date through the transformation; the overlap picks up upstream corrections of recent days. If any older row has changed, weeks have been removed from the admissions calendar, or the transformation or its parameters have changed, the table is rebuilt from scratch.
 
 # In[27]:
 
 
-# Step 1: Convert daily data to weekly
-# Note: rolling_sum column contains 7 days rolling cases information, therefore this column will be kept to show weekly cases.
+INCREMENTAL_REFRESH = os.environ.get('INCREMENTAL_REFRESH') == '1'
+INCREMENTAL_DIR = os.path.join(CACHE_DIR, 'weekly')
+OVERLAP_DAYS = 14
+
+
+def history_digest(df_name, date_column_name, before):
+    # number and order independent hash of the rows dated before `before`
+    df = df_name[df_name[date_column_name] < before]
+    df = df.astype({column: 'int64' for column in df.columns if pd.api.types.is_integer_dtype(df[column])})
+    return [int(len(df)), int(pd.util.hash_pandas_object(df, index=False).to_numpy().sum(dtype='uint64'))]
+
+
+def concat_weekly(stored, new):
+    df = pd.concat([stored, new], ignore_index=True)
+    for column in stored.columns:
+        # categoricals with different categories are concatenated as strings
+        if isinstance(stored[column].dtype, pd.CategoricalDtype) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df.sort_values('date', kind='stable', ignore_index=True)
+
+
+@profiled
+def refresh_weekly_table(name, transform, df_name, date_column_name, week_endings, state_dir=INCREMENTAL_DIR,
+                         overlap_days=OVERLAP_DAYS, lookback_days=0, **params):
+    # lookback_days: days before the first new row the transformation needs, e.g. for a rolling sum over more than a week
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, name + '.json')
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    # New admissions weeks may only be added at the end, otherwise the table is rebuilt
+    calendar = [str(pd.Timestamp(i).date()) for i in week_endings]
+    transform_key = hashlib.sha1((function_fingerprint(transform) + value_fingerprint(params)).encode('utf-8')).hexdigest()
+    rebuild = (state is None or calendar[:len(state['calendar'])] != state['calendar'] or state['transform'] != transform_key
+               or not os.path.exists(state['file']))
+    if not rebuild:
+        rebuild = history_digest(df_name, date_column_name, pd.Timestamp(state['cutoff'])) != state['digest']
+
+    if rebuild:
+        new_rows = df_name
+        table = transform(df_name, week_endings, **params).sort_values('date', kind='stable', ignore_index=True)
+    else:
+        # from the stored cutoff, or from the first day of the first new week if that is earlier
+        cutoff = pd.Timestamp(state['cutoff'])
+        new_weeks = calendar[len(state['calendar']):]
+        if new_weeks:
+            cutoff = min(cutoff, pd.Timestamp(new_weeks[0]) - pd.Timedelta(days=6))
+        new_rows = df_name[df_name[date_column_name] >= cutoff - pd.Timedelta(days=lookback_days)]
+        new = transform(new_rows, week_endings, **params)
+        stored = read_cached_frame(state['file'])
+        table = concat_weekly(stored[stored['date'] < cutoff], new[new['date'] >= cutoff])
+
+    last_date = df_name[date_column_name].max()
+    cutoff = last_date - pd.Timedelta(days=overlap_days)
+    state = {'calendar': calendar, 'transform': transform_key, 'file': write_cached_frame(table, os.path.join(state_dir, name)),
+             'last_date': str(last_date.date()), 'cutoff': str(cutoff.date()), 'digest': history_digest(df_name, date_column_name, cutoff)}
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    return table, {'refresh': 'rebuilt' if rebuild else 'incremental', 'rows_processed': len(new_rows),
+                   'source_rows': len(df_name), 'last_date': str(last_date.date())}
+
+
+refresh_reports = {}
+
+
+def weekly_table(name, transform, df_name, date_column_name, week_endings, lookback_days=0, **params):
+    # with INCREMENTAL_REFRESH=1 the table is refreshed from the stored one, otherwise it is built from all the rows
+    if not INCREMENTAL_REFRESH:
+        return transform(df_name, week_endings, **params)
+    table, refresh_reports[name] = refresh_weekly_table(name, transform, df_name, date_column_name, week_endings,
+                                                        lookback_days=lookback_days, **params)
+    return table
 
-# Set the index to be aligned to (not needed for other dataframes)
-filters_index = admissions_by_age.set_index(['week_ending'])
 
-# Align indices
-to_be_filtered_index = cases_by_age.set_index(['date'])
+# ##### Cases by age
 
-# Calculate & apply mask
-weekly_cases_by_age = to_be_filtered_index[to_be_filtered_index.index.isin(filters_index.index)].reset_index()
+# In[28]:
 
-# Step 2: Keep the columns to be used and remove the rest, rename the columns
-weekly_cases_by_age = weekly_cases_by_age[['date','age_band','rolling_sum','population']]
-weekly_cases_by_age = weekly_cases_by_age.rename(columns = {'rolling_sum' : 'weekly_cases', 'age_band':'age_band_original'}, inplace = False)
 
-# Case specific step: Drop the rows including "unassigned" as age_band.
-weekly_cases_by_age = weekly_cases_by_age[weekly_cases_by_age.age_band_original != 'unassigned']
+@profiled
+def to_weekly_cases(cases_by_age, week_endings, window_days=7, area_column_names=(), how='snapshot'):
+    weekly_cases_by_age = load_stage(cases_by_age)
 
-# Step 3: Combine age groups into fewer buckets
-# The new buckets will be as follows: 0 - 24 years, 25 - 39 years, 40 - 54 years, 55 - 69 years, 70+ years.
+    # Step 1: Convert daily data to weekly
+    # Note: rolling_sum column contains 7 days rolling cases information, therefore this column will be kept to show weekly cases.
+    # For a different window, e.g. 14 or 28 days, rolling_sum is recomputed from the daily cases.
+    if how == 'snapshot':
+        if window_days != 7:
+            weekly_cases_by_age = run_stage(replace_rolling_sum, weekly_cases_by_age, window_days=window_days)
 
-# Create a list of our conditions
-conditions = []
-for i,j in enumerate(weekly_cases_by_age.age_band_original.unique()):
-    conditions.append("(weekly_cases_by_age['age_band_original'] == '" + j +"')")
-    i+=1
-conditions=list(map(eval, conditions))
+        # Keep the rows dated on a week ending
+        weekly_cases_by_age = run_stage(align_weekly, weekly_cases_by_age, week_endings=week_endings, date_column_name='date', how='snapshot')
+        cases_column_name = 'rolling_sum'
+    else:
+        # how='sum' or 'mean': the daily cases of the seven days up to each week ending are summed or averaged instead.
+        # Note: population is the same every day, it is kept as a key so that it isn't summed as well.
+        weekly_cases_by_age = run_stage(align_weekly, weekly_cases_by_age, week_endings=week_endings, date_column_name='date', how=how,
+                                        key_column_names=['area_code','age_band','population'], value_column_names=['cases'])
+        cases_column_name = 'cases'
 
-# Create a list of the values we want to assign for each condition
-values = ['0 - 24 years','0 - 24 years','0 - 24 years','0 - 24 years','0 - 24 years','25 - 39 years','25 - 39 years','25 - 39 years','40 - 54 years','40 - 54 years','40 - 54 years','55 - 69 years','55 - 69 years','55 - 69 years',
-         '70+ years','70+ years','70+ years','70+ years','70+ years']
+    # Step 2: Keep the columns to be used and remove the rest, rename the columns
+    # Case specific step: Drop the rows including "unassigned" as age_band.
+    # Note: area_column_names, e.g. ['area_code'], are kept to get one table per area instead of London as a whole.
+    weekly_cases_by_age = run_stage(project_columns, weekly_cases_by_age, columns=list(area_column_names) + ['date','age_band',cases_column_name,'population'],
+                                    rename={cases_column_name : 'weekly_cases', 'age_band':'age_band_original'},
+                                    drop_values={'age_band_original': ['unassigned']})
 
-# Create a new column and assign values to it using our lists as arguments
-weekly_cases_by_age['age_band'] = np.select(conditions, values)
+    # Step 3: Combine age groups into fewer buckets
+    # The new buckets will be as follows: 0 - 24 years, 25 - 39 years, 40 - 54 years, 55 - 69 years, 70+ years.
+    weekly_cases_by_age = run_stage(reband, weekly_cases_by_age, age_band_column_name='age_band_original', scheme=FIVE_AGE_BANDS)
 
-# Remove age_band_original column
-weekly_cases_by_age = weekly_cases_by_age[['date','age_band','weekly_cases','population']]
+    # Sum the rows of each new bucket, this also removes age_band_original column
+    weekly_cases_by_age = run_stage(consolidate, weekly_cases_by_age, key_column_names=list(area_column_names) + ['date','age_band'],
+                                    value_column_names=['weekly_cases','population'])
+    return weekly_cases_by_age.df
 
-# Remove duplicate rows
-weekly_cases_by_age[['weekly_cases', 'population']] = weekly_cases_by_age.groupby(['date','age_band'], as_index=False)[['weekly_cases', 'population']].transform('sum')
-weekly_cases_by_age = weekly_cases_by_age.drop_duplicates()
 
-weekly_cases_by_age.head()
+CASES_WINDOW_DAYS = 7
 
+# Check the recomputed 7 day sums against the upstream rolling_sum column
+rolling_sum_7 = rolling_window(cases_by_age, 'date', 'cases', ['area_code', 'age_band'], window=7)
+print('Recomputed 7 day sums matching rolling_sum:', "{:.2%}".format((rolling_sum_7 == cases_by_age['rolling_sum']).mean()))
 
-# In[28]:
+# Set the week ending dates to be aligned to (not needed for other dataframes)
+week_endings = week_ending_calendar(admissions_by_age['week_ending'])
 
+weekly_cases_by_age = weekly_table('weekly_cases_by_age', to_weekly_cases, cases_by_age, 'date', week_endings,
+                                   lookback_days=CASES_WINDOW_DAYS, window_days=CASES_WINDOW_DAYS)
 
-one_variable_graph(weekly_cases_by_age, 'date', 'weekly_cases', 'Weekly Cases', 'Date', 'Number of Cases')
-
+weekly_cases_by_age.head()
 
-# ##### Vaccinations by age
 
 # In[29]:
 
 
-# Step 1: Convert daily data to weekly
-# Note: Cumulative vaccination data will be used, therefore cum_doses column will be used.
-
-# Align indices
-to_be_filtered_index = vaccines_by_age.set_index(['date'])
+one_variable_graph(weekly_cases_by_age, 'date', 'weekly_cases', 'Weekly Cases', 'Date', 'Number of Cases')
 
-# Calculate & apply mask
-weekly_vaccines_by_age = to_be_filtered_index[to_be_filtered_index.index.isin(filters_index.index)].reset_index()
 
-# Step 2: Keep the columns to be used and remove the rest, rename the columns
-weekly_vaccines_by_age = weekly_vaccines_by_age[['date','dose','age_band','cum_doses','population']]
+# ##### Vaccinations by age
 
-# Remove duplicate rows
-weekly_vaccines_by_age[['cum_doses', 'population']] = weekly_vaccines_by_age.groupby(['date','dose','age_band'], as_index=False)[['cum_doses', 'population']].transform('sum')
-weekly_vaccines_by_age = weekly_vaccines_by_age.drop_duplicates()
+# In[30]:
 
-# Step 3: Combine age groups into fewer buckets
-# Note: The new buckets will be as follows: 0 - 24 years, 25 - 39 years, 40 - 54 years, 55 - 69 years, 70+ years.
 
-# Create a list of our conditions
-conditions = []
-for i,j in enumerate(weekly_vaccines_by_age.age_band.unique()):
-    conditions.append("(weekly_vaccines_by_age['age_band'] == '" + j +"')")
-    i+=1
-conditions=list(map(eval, conditions))
+@profiled
+def to_weekly_vaccines(vaccines_by_age, week_endings, area_column_names=(), how='snapshot'):
+    # Step 1: Convert daily data to weekly
+    # Note: Cumulative vaccination data will be used, therefore cum_doses column will be used.
+    if how == 'snapshot':
+        # Keep the rows dated on a week ending
+        weekly_vaccines_by_age = run_stage(align_weekly, vaccines_by_age, week_endings=week_endings, date_column_name='date', how='snapshot')
+        doses_column_name = 'cum_doses'
+    else:
+        # how='sum' or 'mean': the new doses of the seven days up to each week ending are summed or averaged instead,
+        # and the table has a new_doses column in place of cum_doses. Population is kept as a key, as for the cases.
+        weekly_vaccines_by_age = run_stage(align_weekly, vaccines_by_age, week_endings=week_endings, date_column_name='date', how=how,
+                                           key_column_names=['area_code','dose','age_band','population'], value_column_names=['new_doses'])
+        doses_column_name = 'new_doses'
 
-# Create a list of the values we want to assign for each condition
-values = ['0 - 24 years','25 - 39 years','25 - 39 years','25 - 39 years','40 - 54 years','40 - 54 years','40 - 54 years','55 - 69 years','55 - 69 years','55 - 69 years',
-         '70+ years','70+ years','70+ years']
+    # Step 2: Keep the columns to be used and remove the rest, rename the columns
+    # Note: area_column_names, e.g. ['area_code'], are kept to get one table per area instead of London as a whole.
+    weekly_vaccines_by_age = run_stage(project_columns, weekly_vaccines_by_age, columns=list(area_column_names) + ['date','dose','age_band',doses_column_name,'population'])
 
-# Create a new column and assign values to it using our lists as arguments
-weekly_vaccines_by_age['age_band_new'] = np.select(conditions, values)
+    # Step 3: Combine age groups into fewer buckets
+    # Note: The new buckets will be as follows: 0 - 24 years, 25 - 39 years, 40 - 54 years, 55 - 69 years, 70+ years.
+    weekly_vaccines_by_age = run_stage(reband, weekly_vaccines_by_age, age_band_column_name='age_band', scheme=FIVE_AGE_BANDS)
 
-# Remove age_band_original column and rename the new column
-weekly_vaccines_by_age = weekly_vaccines_by_age[['date','dose','age_band_new','cum_doses','population']]
-weekly_vaccines_by_age = weekly_vaccines_by_age.rename(columns = {'age_band_new' : 'age_band'}, inplace = False)
+    # Sum the rows of each date, dose and new bucket
+    weekly_vaccines_by_age = run_stage(consolidate, weekly_vaccines_by_age, key_column_names=list(area_column_names) + ['date','dose','age_band'],
+                                       value_column_names=[doses_column_name,'population'])
+    return weekly_vaccines_by_age.df
 
-# Remove duplicate rows
-weekly_vaccines_by_age[['cum_doses', 'population']] = weekly_vaccines_by_age.groupby(['date','dose','age_band'], as_index=False)[['cum_doses', 'population']].transform('sum')
-weekly_vaccines_by_age = weekly_vaccines_by_age.drop_duplicates()
 
+weekly_vaccines_by_age = weekly_table('weekly_vaccines_by_age', to_weekly_vaccines, vaccines_by_age, 'date', week_endings)
 
 weekly_vaccines_by_age.head()
 
 
-# In[30]:
+# In[31]:
 
 
 one_variable_graph(weekly_vaccines_by_age, 'date', 'cum_doses', 'Cumulative Vaccination Figures', 'Date', 'Number of Vaccinations (1st and 2nd dose combined)')
@@ -441,41 +1291,30 @@ one_variable_graph(weekly_vaccines_by_age, 'date', 'cum_doses', 'Cumulative Vacc
 
 # ##### Admissions by age
 
-# In[31]:
-
-
-# Step 1: Not needed, data is already weekly.
-# Step 2: Keep the columns to be used and remove the rest, rename the columns
-weekly_admissions_by_age = admissions_by_age[['week_ending','age','weekly_admissions']]
-weekly_admissions_by_age = weekly_admissions_by_age.rename(columns = {'week_ending': 'date', 'age': 'age_band_original'}, inplace = False)
-
-# Step 3: Combine age groups into fewer buckets
-# Note: Unfortunately, the age groups of this dataset doesn't match the other datasets, and is not granular enough.
-# Note: The new buckets will be as follows: 0 - 17 years, 18 - 64 years, 65+ years.
+# In[32]:
 
-# Create a list of our conditions
-conditions = []
-for i,j in enumerate(weekly_admissions_by_age.age_band_original.unique()):
-    conditions.append("(weekly_admissions_by_age['age_band_original'] == '" + j +"')")
-    i +=1
-conditions=list(map(eval, conditions))
 
-# Create a list of the values we want to assign for each condition
-values = ['0 - 17 years','18 - 64 years','0 - 17 years','65+ years','65+ years']
+@profiled
+def to_weekly_admissions(admissions_by_age, week_endings=None):
+    # Step 1: Not needed, data is already weekly.
+    # Step 2: Keep the columns to be used and remove the rest, rename the columns
+    weekly_admissions_by_age = run_stage(project_columns, admissions_by_age, columns=['week_ending','age','weekly_admissions'],
+                                         rename={'week_ending': 'date', 'age': 'age_band_original'})
 
-# Create a new column and assign values to it using our lists as arguments
-weekly_admissions_by_age['age_band'] = np.select(conditions, values)
+    # Step 3: Combine age groups into fewer buckets
+    # Note: Unfortunately, the age groups of this dataset doesn't match the other datasets, and is not granular enough.
+    # Note: The new buckets will be as follows: 0 - 17 years, 18 - 64 years, 65+ years.
+    weekly_admissions_by_age = run_stage(reband, weekly_admissions_by_age, age_band_column_name='age_band_original', scheme=ADMISSIONS_AGE_BANDS)
 
-# Remove age_band_original column
-weekly_admissions_by_age = weekly_admissions_by_age[['date','age_band','weekly_admissions']]
+    # Sum the rows of each new bucket, this also removes age_band_original column
+    weekly_admissions_by_age = run_stage(consolidate, weekly_admissions_by_age, key_column_names=['date','age_band'], value_column_names=['weekly_admissions'])
+    return weekly_admissions_by_age.df
 
-# Remove duplicate rows
-weekly_admissions_by_age[['weekly_admissions']] = weekly_admissions_by_age.groupby(['date','age_band'], as_index=False)[['weekly_admissions']].transform('sum')
 
-weekly_admissions_by_age = weekly_admissions_by_age.drop_duplicates()
+weekly_admissions_by_age = weekly_table('weekly_admissions_by_age', to_weekly_admissions, admissions_by_age, 'week_ending', week_endings)
 
 
-# In[32]:
+# In[33]:
 
 
 one_variable_graph(weekly_admissions_by_age, 'date', 'weekly_admissions', 'Weekly Hospital Admissions', 'Date', 'Number of Admissions')
@@ -483,27 +1322,31 @@ one_variable_graph(weekly_admissions_by_age, 'date', 'weekly_admissions', 'Weekl
 
 # ##### Restrictions
 
-# In[33]:
+# In[34]:
 
 
-# Step 1: Convert daily data to weekly
-# When converting to daily, some data may be lost due to some restrictions starting within the week, however this is negligible for our purpose.
+@profiled
+def to_weekly_restrictions(restrictions, week_endings, how='snapshot'):
+    # Step 1: Convert daily data to weekly
+    # When converting to daily, some data may be lost due to some restrictions starting within the week, however this is negligible for our purpose.
+    # Note: with how='sum' or 'mean' nothing is lost, the flags become the number or the share of days of each week the restriction was in force.
 
-# Align indices
-to_be_filtered_index = restrictions.set_index(['date'])
+    # Keep the rows dated on a week ending
+    weekly_restrictions = run_stage(align_weekly, restrictions, week_endings=week_endings, date_column_name='date', how=how)
 
-# Calculate & apply mask
-weekly_restrictions = to_be_filtered_index[to_be_filtered_index.index.isin(filters_index.index)].reset_index()
+    # Case specific step: Reverse the sign of the "eat out to help out" column
+    weekly_restrictions = run_stage(project_columns, weekly_restrictions, negate=['eat_out_to_help_out'])
 
-# Case specific step: Reverse the sign of the "eat out to help out" column
-weekly_restrictions['eat_out_to_help_out'] = weekly_restrictions['eat_out_to_help_out'] * -1
+    # Step 2 and 3 are not applicable.
+    return weekly_restrictions.df
 
-# Step 2 and 3 are not applicable.
+
+weekly_restrictions = weekly_table('weekly_restrictions', to_weekly_restrictions, restrictions, 'date', week_endings)
 
 weekly_restrictions.head()
 
 
-# In[34]:
+# In[35]:
 
 
 multi_value_stacked_graph(weekly_restrictions, 'date', 'Restrictions', 'Date', 'Restrictions')
@@ -511,33 +1354,283 @@ multi_value_stacked_graph(weekly_restrictions, 'date', 'Restrictions', 'Date', '
 
 # ##### Testing
 
-# In[35]:
+# In[36]:
+
 
+@profiled
+def to_weekly_testing(testing, week_endings, how='snapshot'):
+    # Step 1: Convert daily data to weekly
+    # Note: uniquePeopleTestedBySpecimenDateRollingSum field already includes rolling 7 day figures.
+    # With how='mean' these are averaged over the seven days up to each week ending ('sum' adds up seven 7 day figures).
 
-# Step 1: Convert daily data to weekly
-# Note: uniquePeopleTestedBySpecimenDateRollingSum field already includes rolling 7 day figures.
+    # Keep the rows dated on a week ending
+    if how == 'snapshot':
+        weekly_testing = run_stage(align_weekly, testing, week_endings=week_endings, date_column_name='date', how='snapshot')
+    else:
+        weekly_testing = run_stage(align_weekly, testing, week_endings=week_endings, date_column_name='date', how=how,
+                                   value_column_names=['uniquePeopleTestedBySpecimenDateRollingSum'])
 
-# Align indices
-to_be_filtered_index = testing.set_index(['date'])
+    # Step 2: Keep the columns to be used and remove the rest, rename the columns
+    weekly_testing = run_stage(project_columns, weekly_testing, columns=['date','uniquePeopleTestedBySpecimenDateRollingSum'],
+                               rename={'uniquePeopleTestedBySpecimenDateRollingSum': 'weekly_PCR_tests'})
 
-# Calculate & apply mask
-weekly_testing = to_be_filtered_index[to_be_filtered_index.index.isin(filters_index.index)].reset_index()
+    # Step 3 is not applicable.
+    return weekly_testing.df
 
-# Step 2: Keep the columns to be used and remove the rest, rename the columns
-weekly_testing = weekly_testing[['date','uniquePeopleTestedBySpecimenDateRollingSum']]
-weekly_testing = weekly_testing.rename(columns = {'uniquePeopleTestedBySpecimenDateRollingSum': 'weekly_PCR_tests'}, inplace = False)
 
-# Step 3 is not applicable.
+weekly_testing = weekly_table('weekly_testing', to_weekly_testing, testing, 'date', week_endings)
 
 weekly_testing.head()
 
 
-# In[36]:
+# In[37]:
 
 
 one_variable_graph(weekly_testing, 'date', 'weekly_PCR_tests', 'Weekly PCR Tests', 'Date', 'Number of PCR Tests')
 
 
+# ##### Rates per 100K and vaccine uptake
+
+# Cases and admissions are turned into rates per 100K people of each age band, and doses into the percentage of each age band vaccinated. The admissions come in 3 bands (0 - 17, 18 - 64, 65+) that don't line up with the 5 bands of the cases, so they are shared out between the 5 bands in proportion to the population the bands have in common. The population of each year of age is taken from the population of the original (5 year) bands of the cases, spread evenly over the years of the band.
+
+# In[38]:
+
+
+PER_100K = 100000
+OLDEST_AGE = 100
+
+
+def rate(counts, population, per=PER_100K):
+    # the counts are often narrow integers, which would overflow when multiplied
+    counts = np.asarray(counts, dtype='float64')
+    population = np.asarray(population, dtype='float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(population > 0, counts / population * per, np.nan)
+
+
+def age_band_matrix(age_bands, oldest_age=OLDEST_AGE):
+    # bands x years of age, True where the year is in the band; open ended bands run to oldest_age
+    limits = [age_band_limits(age_band) for age_band in age_bands]
+    lowest = np.array([i for i, _ in limits], dtype='int64')
+    highest = np.array([oldest_age - 1 if i is None else i for _, i in limits], dtype='int64')
+    ages = np.arange(oldest_age)
+    return (ages >= lowest[:, None]) & (ages <= highest[:, None])
+
+
+def population_by_age(df_name, age_band_column_name='age_band', population_column_name='population', oldest_age=OLDEST_AGE):
+    # latest population of each age band and area, spread evenly over the years of the band and summed over the areas
+    df = df_name[df_name[age_band_column_name] != 'unassigned']
+    area_column_names = [i for i in ('area_code',) if i in df.columns]
+    df = df.sort_values('date').drop_duplicates(area_column_names + [age_band_column_name], keep='last')
+    bands = age_band_matrix(df[age_band_column_name], oldest_age)
+    return (bands * (df[population_column_name].to_numpy('float64') / bands.sum(axis=1))[:, None]).sum(axis=0)
+
+
+def reallocation_weights(from_age_bands, to_age_bands, age_population):
+    # share of the population of each `from` band that falls into each `to` band; each row sums to 1
+    overlap = (age_band_matrix(from_age_bands, len(age_population)) * age_population) @ age_band_matrix(to_age_bands, len(age_population)).T
+    return overlap / overlap.sum(axis=1, keepdims=True)
+
+
+def reallocate_age_bands(df_name, value_column_name, to_scheme, age_population, date_column_name='date', age_band_column_name='age_band'):
+    # dates x `from` bands, times the weights, gives dates x `to` bands in one matrix product
+    wide = df_name.groupby([date_column_name, age_band_column_name], sort=True, observed=False)[value_column_name].sum().unstack(age_band_column_name)
+    weights = reallocation_weights(wide.columns, list(to_scheme), age_population)
+    values = wide.to_numpy('float64') @ weights
+    return pd.DataFrame({date_column_name: np.repeat(wide.index.to_numpy(), len(to_scheme)),
+                         age_band_column_name: pd.Categorical(np.tile(list(to_scheme), len(wide)), categories=list(to_scheme), ordered=True),
+                         value_column_name: values.ravel()})
+
+
+@profiled
+def weekly_rates(weekly_cases_by_age, weekly_admissions_by_age, age_population):
+    df = weekly_cases_by_age.merge(reallocate_age_bands(weekly_admissions_by_age, 'weekly_admissions', FIVE_AGE_BANDS, age_population),
+                                   on=['date', 'age_band'], how='left')
+    return df.assign(cases_per_100k=rate(df['weekly_cases'], df['population']),
+                     admissions_per_100k=rate(df['weekly_admissions'], df['population']))
+
+
+@profiled
+def weekly_uptake(weekly_vaccines_by_age):
+    # percentage of each age band that has had each dose
+    return weekly_vaccines_by_age.assign(uptake_percent=rate(weekly_vaccines_by_age['cum_doses'], weekly_vaccines_by_age['population'], per=100))
+
+
+age_population = population_by_age(cases_by_age)
+weekly_rates_by_age = weekly_rates(weekly_cases_by_age, weekly_admissions_by_age, age_population)
+weekly_uptake_by_age = weekly_uptake(weekly_vaccines_by_age)
+
+# Admissions bands shared out between the 5 bands
+print(pd.DataFrame(reallocation_weights(list(ADMISSIONS_AGE_BANDS), list(FIVE_AGE_BANDS), age_population),
+                   index=list(ADMISSIONS_AGE_BANDS), columns=list(FIVE_AGE_BANDS)).round(3))
+
+weekly_rates_by_age.head()
+
+
+# ##### Refreshing all the tables
+
+# refresh_weekly_tables() refreshes the five weekly tables at once from a set of datasets, e.g. from a scheduled job, in the same way as the cells above do with INCREMENTAL_REFRESH=1. The refresh of the tables above is reported here.
+
+# In[39]:
+
+
+# weekly table: (source, date column of the source, transformation)
+WEEKLY_TABLES = {
+    'weekly_cases_by_age': ('cases_by_age', 'date', to_weekly_cases),
+    'weekly_vaccines_by_age': ('vaccines_by_age', 'date', to_weekly_vaccines),
+    'weekly_admissions_by_age': ('admissions_by_age', 'week_ending', to_weekly_admissions),
+    'weekly_restrictions': ('restrictions', 'date', to_weekly_restrictions),
+    'weekly_testing': ('testing', 'date', to_weekly_testing),
+}
+
+
+@profiled
+def refresh_weekly_tables(datasets, state_dir=INCREMENTAL_DIR, overlap_days=OVERLAP_DAYS, tables=WEEKLY_TABLES):
+    week_endings = week_ending_calendar(datasets.admissions_by_age['week_ending'])
+    weekly_tables = {}
+    report = {}
+    for name, (source, date_column_name, transform) in tables.items():
+        weekly_tables[name], report[name] = refresh_weekly_table(name, transform, getattr(datasets, source), date_column_name, week_endings,
+                                                                 state_dir=state_dir, overlap_days=overlap_days)
+    return weekly_tables, pd.DataFrame(report).T
+
+
+if INCREMENTAL_REFRESH:
+    print(pd.DataFrame(refresh_reports).T)
+
+
+# ##### Per-borough tables
+
+# Section 4 drops area_name and area_code to analyse London as a whole. With BOROUGH_MODE=1 the cases and vaccines are also taken through the same weekly alignment and re-banding per area_code, in one grouped pass, giving long tables keyed by area_code, date and age band. by_area() does the same by partitioning the frame on area_code and running the transformation on each partition in a process pool.
+
+# In[40]:
+
+
+BOROUGH_MODE = os.environ.get('BOROUGH_MODE') == '1'
+
+
+def transform_partition(transform, partition, params):
+    area_code, df = partition
+    return transform(df, **params).assign(area_code=area_code)
+
+
+def no_stage_cache():
+    # the workers would otherwise write to, and evict from, the same stage cache at once
+    global STAGE_CACHE
+    STAGE_CACHE = False
+
+
+@profiled
+def by_area(transform, df_name, area_column_name='area_code', workers=None, **params):
+    partitions = list(df_name.groupby(area_column_name, sort=True, observed=True))
+    with ProcessPoolExecutor(workers, initializer=no_stage_cache) as pool:
+        results = list(pool.map(functools.partial(transform_partition, transform, params=params), partitions))
+
+    df = pd.concat(results, ignore_index=True)
+    df[area_column_name] = df[area_column_name].astype(df_name[area_column_name].dtype)
+    return df[[area_column_name] + [i for i in df.columns if i != area_column_name]]
+
+
+if BOROUGH_MODE:
+    weekly_cases_by_borough = to_weekly_cases(cases_by_age, week_endings, CASES_WINDOW_DAYS, area_column_names=['area_code'])
+    weekly_vaccines_by_borough = to_weekly_vaccines(vaccines_by_age, week_endings, area_column_names=['area_code'])
+    print('Areas:', weekly_cases_by_borough['area_code'].nunique(), 'with cases,', weekly_vaccines_by_borough['area_code'].nunique(), 'with vaccinations')
+
+
+# ##### Weekly store
+
+# With WEEKLY_STORE=1 the weekly tables are written to a SQLite file with one index per table over the age band, dose, area and date columns it has. query_store() reads back the rows and columns a question needs, e.g. the cases of the 70+ between two dates, without running the notebook again. The dtypes of the columns are stored next to the tables and restored on reading.
+
+# In[41]:
+
+
+STORE_PATH = os.path.join(CACHE_DIR, 'weekly.sqlite')
+# columns of the index of each table, in this order: those compared for equality first, and date, compared to a range, last
+STORE_INDEX_COLUMNS = ['age_band', 'dose', 'area_code', 'date']
+WEEKLY_STORE = os.environ.get('WEEKLY_STORE') == '1'
+
+
+def store_value(value, dtype):
+    # dates are stored as ISO text, which sorts and compares in date order
+    if dtype.startswith('datetime64'):
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+    return value.item() if isinstance(value, np.generic) else value
+
+
+@profiled
+def write_store(tables, path=STORE_PATH, index_column_names=STORE_INDEX_COLUMNS):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path)
+    try:
+        with con:
+            con.execute('CREATE TABLE IF NOT EXISTS store_schema (table_name TEXT, column_name TEXT, dtype TEXT, categories TEXT)')
+            for name, df in tables.items():
+                schema = [(name, column, str(df[column].dtype), json.dumps(list(df[column].cat.categories) + [df[column].cat.ordered])
+                           if isinstance(df[column].dtype, pd.CategoricalDtype) else None) for column in df.columns]
+                con.execute('DELETE FROM store_schema WHERE table_name = ?', (name,))
+                con.executemany('INSERT INTO store_schema VALUES (?, ?, ?, ?)', schema)
+
+                df = df.assign(**{column: df[column].dt.strftime('%Y-%m-%d') if pd.api.types.is_datetime64_any_dtype(df[column])
+                                  else df[column].astype(object) for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])})
+                df.to_sql(name, con, if_exists='replace', index=False)
+                index = [column for column in index_column_names if column in df.columns]
+                if index:
+                    con.execute('CREATE INDEX "%s_index" ON "%s" (%s)' % (name, name, ', '.join('"%s"' % column for column in index)))
+            # statistics for the query planner, which let it skip over the leading columns of an index that a query doesn't filter
+            con.execute('ANALYZE')
+    finally:
+        con.close()
+    return path
+
+
+@profiled
+def query_store(table_name, columns=None, where=None, path=STORE_PATH):
+    # where takes the same conditions as row_filter: a list of values to keep or a (lowest, highest) tuple per column
+    con = sqlite3.connect(path)
+    try:
+        schema = {column: (dtype, categories) for column, dtype, categories in
+                  con.execute('SELECT column_name, dtype, categories FROM store_schema WHERE table_name = ?', (table_name,))}
+        if not schema:
+            raise KeyError('No table %r in %s' % (table_name, path))
+        columns = list(schema) if columns is None else list(columns)
+
+        clauses, params = [], []
+        for column, condition in (where or {}).items():
+            if isinstance(condition, tuple):
+                for operator, value in zip(('>=', '<='), condition):
+                    if value is not None:
+                        clauses.append('"%s" %s ?' % (column, operator))
+                        params.append(store_value(value, schema[column][0]))
+            else:
+                clauses.append('"%s" IN (%s)' % (column, ', '.join('?' * len(condition))))
+                params.extend(store_value(value, schema[column][0]) for value in condition)
+        query = 'SELECT %s FROM "%s"' % (', '.join('"%s"' % column for column in columns), table_name)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        df = pd.read_sql_query(query, con, params=params)
+    finally:
+        con.close()
+
+    for column in columns:
+        dtype, categories = schema[column]
+        if categories is not None:
+            categories = json.loads(categories)
+            df[column] = pd.Categorical(df[column], categories=categories[:-1], ordered=categories[-1])
+        elif dtype.startswith('datetime64'):
+            df[column] = pd.to_datetime(df[column])
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+if WEEKLY_STORE:
+    store_tables = {name: globals()[name] for name in WEEKLY_TABLES}
+    if BOROUGH_MODE:
+        store_tables.update(weekly_cases_by_borough=weekly_cases_by_borough, weekly_vaccines_by_borough=weekly_vaccines_by_borough)
+    write_store(store_tables)
+    print(query_store('weekly_cases_by_age', where={'age_band': ['70+ years'], 'date': ('2021-01-01', '2021-06-30')}).head())
+
+
 # ### 6. Limitations
 
 # * The age bands of admissions dataset is not optimal. 18 - 64 years section is very large. The data will be used as is, because despite the low granularity, the dataset will be sufficient for our purpose.
@@ -554,10 +1647,863 @@ one_variable_graph(weekly_testing, 'date', 'weekly_PCR_tests', 'Weekly PCR Tests
 # 
 # Additionally, utilising more advanced techniques, the data can be modelled to predict the future number of cases and to evaluate and recommend restriction options to flatten the curve.
 
+# ##### Lagged correlations
+
+# The weekly rates, the vaccine uptake and the restriction flags are put side by side in one panel, one column per variable and age band (restrictions apply to all bands). The correlation of every column with every other column some weeks later is worked out for all lags at once as matrix products of the standardised panel. The confidence intervals come from a moving block bootstrap, which keeps the weeks close to each other together; the resamples are split between processes.
+
+# In[42]:
+
+
+MAX_LAG_WEEKS = 8
+BOOTSTRAP_RESAMPLES = 500
+BOOTSTRAP_BLOCK_WEEKS = 4
+
+
+def weekly_panel(weekly_rates_by_age, weekly_uptake_by_age, weekly_restrictions):
+    # one row per week, one (variable, age band) column per series
+    rates = weekly_rates_by_age.set_index(['date', 'age_band'])[['cases_per_100k', 'admissions_per_100k']].unstack('age_band')
+    uptake = weekly_uptake_by_age.set_index(['date', 'dose', 'age_band'])['uptake_percent'].unstack(['dose', 'age_band'])
+    uptake.columns = pd.MultiIndex.from_tuples([('uptake_percent_%s' % str(dose).lower(), age_band) for dose, age_band in uptake.columns])
+    restrictions = weekly_restrictions.set_index('date')
+    restrictions.columns = pd.MultiIndex.from_product([restrictions.columns, ['']])
+
+    # no uptake before the first dose was given
+    panel = pd.concat([rates, uptake.reindex(rates.index).fillna(0), restrictions.reindex(rates.index)], axis=1)
+    panel.columns = panel.columns.set_names(['variable', 'age_band'])
+    return panel.dropna().astype('float64')
+
+
+def standardise(values):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (values - values.mean(axis=0)) / values.std(axis=0)
+
+
+def lagged_correlation(values, max_lag, rows=None):
+    # lags x series x series, [lag, i, j] being the correlation of series i with series j `lag` weeks later;
+    # rows are the (resampled) week positions of the pairs, by default every week that has a partner `lag` weeks on
+    n_weeks, n_series = values.shape
+    correlations = np.full((max_lag + 1, n_series, n_series), np.nan)
+    for lag in range(min(max_lag + 1, n_weeks - 1)):
+        weeks = np.arange(n_weeks - lag) if rows is None else rows[rows < n_weeks - lag]
+        x, y = standardise(values[weeks]), standardise(values[weeks + lag])
+        correlations[lag] = x.T @ y / len(weeks)
+    return correlations
+
+
+def bootstrap_correlations(values, max_lag, n_resamples, block_weeks, seed):
+    rng = np.random.default_rng(seed)
+    n_weeks = len(values)
+    n_blocks = -(-n_weeks // block_weeks)
+    results = np.empty((n_resamples, max_lag + 1) + (values.shape[1],) * 2)
+    for i in range(n_resamples):
+        starts = rng.integers(0, n_weeks - block_weeks + 1, n_blocks)
+        rows = (starts[:, None] + np.arange(block_weeks)).ravel()[:n_weeks]
+        results[i] = lagged_correlation(values, max_lag, rows)
+    return results
+
+
+@profiled
+def lagged_correlations(panel, max_lag=MAX_LAG_WEEKS, n_resamples=BOOTSTRAP_RESAMPLES, block_weeks=BOOTSTRAP_BLOCK_WEEKS,
+                        confidence=0.95, workers=1, seed=0):
+    # workers > 1 runs the resamples in a process pool, which has to be called from under an `if __name__ == '__main__'`
+    # guard when the workers are spawned rather than forked
+    values = panel.to_numpy('float64')
+    correlations = lagged_correlation(values, max_lag)
+
+    if n_resamples:
+        chunks = np.array_split(np.arange(n_resamples), workers)
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        if workers == 1:
+            resamples = [bootstrap_correlations(values, max_lag, n_resamples, block_weeks, seeds[0])]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                resamples = list(pool.map(bootstrap_correlations, [values] * len(chunks), [max_lag] * len(chunks), [len(i) for i in chunks],
+                                          [block_weeks] * len(chunks), seeds))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanquantile(np.concatenate(resamples), [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+
+    # pairs of the same age band, or with a series that applies to all bands, without a series against itself
+    lag, i, j = np.indices(correlations.shape).reshape(3, -1)
+    x_band, y_band = panel.columns.get_level_values('age_band')[i], panel.columns.get_level_values('age_band')[j]
+    keep = ((x_band == y_band) | (x_band == '') | (y_band == '')) & (i != j)
+    df = pd.DataFrame({'x': panel.columns.get_level_values('variable')[i][keep], 'x_age_band': x_band[keep],
+                       'y': panel.columns.get_level_values('variable')[j][keep], 'y_age_band': y_band[keep],
+                       'lag_weeks': lag[keep], 'correlation': correlations.ravel()[keep]})
+    if n_resamples:
+        df['lower'], df['upper'] = lower.ravel()[keep], upper.ravel()[keep]
+    return df
+
+
+weekly_panel_by_age = weekly_panel(weekly_rates_by_age, weekly_uptake_by_age, weekly_restrictions)
+correlations_by_age = lagged_correlations(weekly_panel_by_age)
+
+# How many weeks after the cases do the admissions follow most closely?
+cases_to_admissions = correlations_by_age[(correlations_by_age['x'] == 'cases_per_100k') & (correlations_by_age['y'] == 'admissions_per_100k')]
+cases_to_admissions.loc[cases_to_admissions.groupby('x_age_band')['correlation'].idxmax()]
+
+
+# ##### Forecasting
+
+# Three simple models forecast the weekly cases of every series (age band, or area and age band) at once: log-linear growth over the last weeks, an autoregressive model of the log cases, and a regression of the log cases on last week's log cases and this week's restriction flags. Each model is fitted to all the series in one batched least squares call on stacked arrays. The models are compared by rolling-origin backtests: fitted on the weeks up to each origin and scored on the weeks after it. The origins can be spread over a process pool.
+
+# In[43]:
+
+
+FORECAST_HORIZON = 4
+GROWTH_WINDOW_WEEKS = 6
+AR_ORDER = 2
+FIRST_ORIGIN_WEEKS = 26
+
+
+def batched_least_squares(X, y):
+    # X is series x rows x terms and y series x rows; returns series x terms
+    return (np.linalg.pinv(X) @ y[..., None])[..., 0]
+
+
+def log_linear_forecast(history, horizon, exog=None, window=GROWTH_WINDOW_WEEKS):
+    # history is weeks x series; the trend of the log cases over the last `window` weeks, the last week being t = 0
+    y = np.log1p(history[-window:])
+    t = np.arange(1 - len(y), 1, dtype='float64')
+    slope = ((t - t.mean())[:, None] * (y - y.mean(axis=0))).sum(axis=0) / ((t - t.mean()) ** 2).sum()
+    intercept = y.mean(axis=0) - slope * t.mean()
+    return np.expm1(intercept + slope * np.arange(1, horizon + 1)[:, None])
+
+
+def recursive_forecast(coef, recent, horizon, exog=None):
+    # coef is series x [constant, lag 1 ... lag p, exog terms], recent the last p weeks of the log cases
+    recent = list(recent)
+    order = len(recent)
+    forecasts = []
+    for step in range(horizon):
+        value = coef[:, 0] + sum(coef[:, k + 1] * recent[-k - 1] for k in range(order))
+        if exog is not None:
+            value = value + coef[:, order + 1:] @ exog[step]
+        forecasts.append(value)
+        recent.append(value)
+    return np.expm1(np.array(forecasts))
+
+
+def ar_forecast(history, horizon, exog=None, order=AR_ORDER):
+    y = np.log1p(history)
+    n_weeks, n_series = y.shape
+    lags = np.stack([y[order - k - 1:n_weeks - k - 1] for k in range(order)], axis=-1)
+    X = np.concatenate([np.ones((n_weeks - order, n_series, 1)), lags], axis=-1).transpose(1, 0, 2)
+    return recursive_forecast(batched_least_squares(X, y[order:].T), y[-order:], horizon)
+
+
+def restriction_forecast(history, horizon, exog, lag=1):
+    # exog is weeks x flags for the weeks of history and the weeks forecast, as the restrictions are planned ahead
+    y = np.log1p(history)
+    n_weeks, n_series = y.shape
+    flags = np.broadcast_to(exog[lag:n_weeks], (n_series, n_weeks - lag, exog.shape[1]))
+    X = np.concatenate([np.ones((n_series, n_weeks - lag, 1)), y[:-lag].T[..., None], flags], axis=-1)
+    return recursive_forecast(batched_least_squares(X, y[lag:].T), y[-1:], horizon, exog[n_weeks:n_weeks + horizon])
+
+
+FORECAST_MODELS = {'log_linear': log_linear_forecast, 'ar': ar_forecast, 'restrictions': restriction_forecast}
+
+
+def backtest_origin(model, values, exog, origin, horizon):
+    return model(values[:origin], horizon, exog), values[origin:origin + horizon]
+
+
+@profiled
+def rolling_origin_backtest(values, exog=None, models=FORECAST_MODELS, horizon=FORECAST_HORIZON, first_origin=FIRST_ORIGIN_WEEKS, workers=1):
+    # mean absolute error and symmetric mean absolute percentage error of each model, by weeks ahead;
+    # without exog the model that needs the restrictions is left out
+    origins = list(range(first_origin, len(values) - horizon + 1))
+    if not origins:
+        raise ValueError('%d weeks are too few for a backtest from week %d with a horizon of %d weeks' % (len(values), first_origin, horizon))
+    if exog is None:
+        models = {name: model for name, model in models.items() if model is not restriction_forecast}
+    rows = []
+    for name, model in models.items():
+        if workers == 1:
+            results = [backtest_origin(model, values, exog, origin, horizon) for origin in origins]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(backtest_origin, [model] * len(origins), [values] * len(origins), [exog] * len(origins),
+                                        origins, [horizon] * len(origins), chunksize=max(1, len(origins) // (4 * workers))))
+        forecasts = np.stack([forecast for forecast, _ in results])
+        actuals = np.stack([actual for _, actual in results])
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            errors = np.abs(forecasts - actuals)
+            smape = np.nanmean(np.where(errors > 0, 200 * errors / (np.abs(forecasts) + np.abs(actuals)), 0), axis=(0, 2))
+        rows += [{'model': name, 'weeks_ahead': i + 1, 'mae': errors[:, i].mean(), 'smape': smape[i]} for i in range(horizon)]
+    return pd.DataFrame(rows)
+
+
+weekly_cases_wide = weekly_cases_by_age.set_index(['date', 'age_band'])['weekly_cases'].unstack('age_band')
+restriction_flags = weekly_restrictions.set_index('date').reindex(weekly_cases_wide.index).fillna(0)
+
+forecast_backtest = rolling_origin_backtest(weekly_cases_wide.to_numpy('float64'), restriction_flags.to_numpy('float64'))
+print(forecast_backtest.pivot(index='weeks_ahead', columns='model', values='smape').round(1))
+
+# Cases of the next weeks by age band (the restrictions model needs the planned restrictions, so it is left out)
+next_weeks = pd.date_range(weekly_cases_wide.index[-1], periods=FORECAST_HORIZON + 1, freq='7D')[1:]
+pd.DataFrame(ar_forecast(weekly_cases_wide.to_numpy('float64'), FORECAST_HORIZON), index=next_weeks, columns=weekly_cases_wide.columns).round()
+
+
+# ##### Restriction scenarios
+
+# A restriction scenario is a schedule of the restriction flags for the coming weeks. The log weekly cases of each age band are modelled on the band's own log cases and the log cases of all bands the week before, which links the bands, and on the restrictions in force. The model is fitted on weekly_cases_by_age and weekly_restrictions, and thousands of parameter samples are drawn from the uncertainty of the fit. Every scenario is then run with every sample, week by week, as whole-array operations; the samples are run in chunks so that memory stays bounded, and the chunks can be spread over a process pool. The result is the distribution of the cases of each age band over the scenario weeks.
+
+# In[44]:
+
+
+SCENARIO_WEEKS = 8
+SCENARIO_SAMPLES = 5000
+SCENARIO_CHUNK_SAMPLES = 1000
+
+ScenarioModel = namedtuple('ScenarioModel', ['coef', 'covariance', 'residual_sd', 'last_week', 'ceiling'])
+
+
+def scenario_design(log_cases, flags):
+    # bands x weeks x [constant, own log cases a week before, log cases of all bands a week before, restriction flags]
+    n_weeks, n_bands = log_cases.shape
+    total = np.log1p(np.expm1(log_cases).sum(axis=1))
+    return np.concatenate([np.ones((n_bands, n_weeks - 1, 1)), log_cases[:-1].T[..., None],
+                           np.broadcast_to(total[:-1, None], (n_bands, n_weeks - 1, 1)),
+                           np.broadcast_to(flags[1:n_weeks], (n_bands, n_weeks - 1, flags.shape[1]))], axis=-1)
+
+
+def fit_scenario_model(weekly_cases, flags):
+    # weekly_cases is weeks x bands, flags weeks x restrictions
+    log_cases = np.log1p(weekly_cases)
+    X = scenario_design(log_cases, flags)
+    y = log_cases[1:].T
+    coef = batched_least_squares(X, y)
+    residuals = y - (X @ coef[..., None])[..., 0]
+    residual_sd = np.sqrt((residuals ** 2).sum(axis=1) / max(X.shape[1] - X.shape[2], 1))
+    covariance = residual_sd[:, None, None] ** 2 * np.linalg.pinv(X.transpose(0, 2, 1) @ X)
+    # the simulated cases are capped at ten times the highest week seen, so that unstable samples don't overflow
+    return ScenarioModel(coef, covariance, residual_sd, log_cases[-1], np.log1p(10 * weekly_cases.max(axis=0)))
+
+
+def simulate_chunk(model, schedules, n_samples, seed):
+    # schedules is scenarios x weeks x restrictions; returns the total and the peak weekly cases,
+    # each scenarios x samples x bands
+    rng = np.random.default_rng(seed)
+    values, vectors = np.linalg.eigh(model.covariance)
+    root = vectors * np.sqrt(np.clip(values, 0, None))[:, None, :]
+    coef = model.coef + np.einsum('bij,sbj->sbi', root, rng.standard_normal((n_samples,) + model.coef.shape))
+
+    log_cases = np.broadcast_to(model.last_week, (len(schedules), n_samples, len(model.last_week)))
+    total = np.zeros(log_cases.shape)
+    peak = np.zeros(log_cases.shape)
+    for week in range(schedules.shape[1]):
+        log_total = np.log1p(np.expm1(log_cases).sum(axis=-1, keepdims=True))
+        mean = (coef[..., 0] + coef[..., 1] * log_cases + coef[..., 2] * log_total
+                + np.einsum('sbk,ck->csb', coef[..., 3:], schedules[:, week]))
+        log_cases = np.minimum(mean + model.residual_sd * rng.standard_normal(mean.shape), model.ceiling)
+        cases = np.expm1(np.maximum(log_cases, 0))
+        total += cases
+        peak = np.maximum(peak, cases)
+    return total, peak
+
+
+@profiled
+def simulate_scenarios(model, schedules, n_samples=SCENARIO_SAMPLES, chunk_samples=SCENARIO_CHUNK_SAMPLES, workers=1, seed=0):
+    sizes = [min(chunk_samples, n_samples - i) for i in range(0, n_samples, chunk_samples)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 1:
+        results = [simulate_chunk(model, schedules, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(simulate_chunk, [model] * len(sizes), [schedules] * len(sizes), sizes, seeds))
+    return np.concatenate([total for total, _ in results], axis=1), np.concatenate([peak for _, peak in results], axis=1)
+
+
+def scenario_outcomes(simulated, scenario_names, age_bands, quantiles=(0.05, 0.5, 0.95)):
+    # distribution over the samples of the total and the peak weekly cases, for each scenario and age band
+    frames = []
+    for outcome, values in zip(['total_cases', 'peak_weekly_cases'], simulated):
+        q = np.quantile(values, quantiles, axis=1)
+        frames.append(pd.DataFrame({'scenario': np.repeat(scenario_names, len(age_bands)), 'age_band': np.tile(age_bands, len(scenario_names)),
+                                    'outcome': outcome, 'mean': values.mean(axis=1).ravel(),
+                                    **{'q%02d' % round(i * 100): q[k].ravel() for k, i in enumerate(quantiles)}}))
+    return pd.concat(frames, ignore_index=True)
+
+
+scenario_model = fit_scenario_model(weekly_cases_wide.to_numpy('float64'), restriction_flags.to_numpy('float64'))
+
+
+def restrictions_in_force(*names):
+    unknown = set(names) - set(restriction_flags.columns)
+    if unknown:
+        raise ValueError('Unknown restrictions %s, the restrictions are %s' % (sorted(unknown), list(restriction_flags.columns)))
+    return pd.Series([1.0 if column in names else 0.0 for column in restriction_flags.columns], index=restriction_flags.columns)
+
+
+# Restrictions held for all the scenario weeks
+LOCKDOWN = ['schools_closed', 'pubs_closed', 'shops_closed', 'eating_places_closed', 'stay_at_home_apart_exceptions',
+            'household_mixing_indoors_banned', 'wfh', 'curfew']
+restriction_scenarios = {
+    'as now': restriction_flags.iloc[-1],
+    'all lifted': restrictions_in_force(),
+    'lockdown': restrictions_in_force(*LOCKDOWN),
+    'lockdown, schools open': restrictions_in_force(*[i for i in LOCKDOWN if i != 'schools_closed']),
+}
+schedules = np.stack([np.tile(flags.to_numpy('float64'), (SCENARIO_WEEKS, 1)) for flags in restriction_scenarios.values()])
+
+scenario_results = scenario_outcomes(simulate_scenarios(scenario_model, schedules), list(restriction_scenarios), list(weekly_cases_wide.columns))
+scenario_results[scenario_results['outcome'] == 'total_cases'].pivot(index='age_band', columns='scenario', values='q50').round()
+
+
+# ##### Batch rendering
+
+# In[45]:
+
+
+# Written when the notebook is run with BATCH_RENDER=1; charts whose data and parameters are unchanged are not rendered again
+if BATCH_RENDER:
+    print(render_charts()[['title', 'key', 'rendered']])
+
+
+# ##### Profiling report
+
+# In[46]:
+
+
+# Written when the notebook is run with PROFILE=1
+if PROFILE:
+    print(write_profile_report().groupby('name')[['wall_seconds', 'cpu_seconds', 'peak_mb']].sum())
+
+
 # ### 8. References
 
 # [1] London Datastore, https://data.london.gov.uk/
 
+# ### 9. Appendix: Benchmarks
+
+# The benchmarks and checks below run on synthetic data. They are slow, so they are skipped unless the RUN_BENCHMARKS environment variable is set to 1.
+
+# In[47]:
+
+
+RUN_BENCHMARKS = os.environ.get('RUN_BENCHMARKS') == '1'
+
+
+# Trace construction of the plotting helpers for growing numbers of age bands, boroughs and dates
+def benchmark_trace_build(age_bands=(5, 20, 80), boroughs=(1, 8, 33), days=(120, 600), repeat=3):
+    rng = np.random.default_rng(0)
+    rows = []
+    for n_bands in age_bands:
+        for n_areas in boroughs:
+            for n_days in days:
+                df = pd.MultiIndex.from_product([['area_%d' % i for i in range(n_areas)],
+                                                 pd.date_range('2020-03-01', periods=n_days).strftime('%Y-%m-%d'),
+                                                 ['band_%d' % i for i in range(n_bands)]],
+                                                names=['area_code', 'date', 'age_band']).to_frame(index=False)
+                df['cases'] = rng.poisson(50, len(df))
+
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    legend_traces(df, 'date', 'cases', 'age_band')
+                    timings.append(time.perf_counter() - start)
+                rows.append({'age_bands': n_bands, 'boroughs': n_areas, 'dates': n_days, 'rows': len(df), 'seconds': min(timings)})
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_trace_build())
+
+
+# In[48]:
+
+
+# Band consolidation: single groupby aggregation against the previous transform('sum') + drop_duplicates
+def consolidate_with_transform(df_name, key_column_names, value_column_names):
+    df = df_name[key_column_names + value_column_names].copy()
+    df[value_column_names] = df.groupby(key_column_names, observed=True)[value_column_names].transform('sum')
+    return df.drop_duplicates()
+
+
+def benchmark_consolidation(scales=(1, 10, 100), days=600, repeat=3):
+    rng = np.random.default_rng(0)
+    age_bands = ['%02d_%02d' % (i, i + 4) for i in range(0, 90, 5)] + ['90+']
+    mapping = age_band_mapping(age_bands, FIVE_AGE_BANDS)
+    rows = []
+    for scale in scales:
+        df = pd.MultiIndex.from_product([['area_%d' % i for i in range(scale)],
+                                         pd.date_range('2020-03-01', periods=days).strftime('%Y-%m-%d'),
+                                         age_bands],
+                                        names=['area_code', 'date', 'age_band_original']).to_frame(index=False)
+        df['weekly_cases'] = rng.poisson(50, len(df))
+        df['population'] = rng.integers(10000, 100000, len(df))
+        df = rebucket_age_bands(df, 'age_band_original', mapping, 'age_band', FIVE_AGE_BANDS)
+
+        timings = {}
+        for name, function in [('transform', consolidate_with_transform), ('aggregate', consolidate)]:
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = function(df, ['date', 'age_band'], ['weekly_cases', 'population'])
+                seconds.append(time.perf_counter() - start)
+            timings[name] = (min(seconds), result)
+
+        # Both paths have to produce the same table, apart from row order and index
+        expected = timings['transform'][1].sort_values(['date', 'age_band']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(timings['aggregate'][1], expected)
+
+        rows.append({'scale': scale, 'rows': len(df), 'transform_seconds': timings['transform'][0],
+                     'aggregate_seconds': timings['aggregate'][0]})
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_consolidation())
+
+
+# In[49]:
+
+
+# Rolling sums of all (area, age band) groups: cumulative sum differencing against pandas rolling per group
+def benchmark_rolling_window(scales=(1, 10, 33), days=600, window=14, repeat=3):
+    rng = np.random.default_rng(0)
+    rows = []
+    for scale in scales:
+        df = pd.MultiIndex.from_product([['area_%d' % i for i in range(scale)],
+                                         ['band_%d' % i for i in range(19)],
+                                         pd.date_range('2020-03-01', periods=days)],
+                                        names=['area_code', 'age_band', 'date']).to_frame(index=False)
+        df['cases'] = rng.poisson(50, len(df))
+        # leave some dates out, so that the windows have gaps
+        df = df[rng.random(len(df)) > 0.05].sort_values(['area_code', 'age_band', 'date']).reset_index(drop=True)
+
+        seconds = {'cumsum': [], 'pandas': []}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rolled = rolling_window(df, 'date', 'cases', ['area_code', 'age_band'], window=window)
+            seconds['cumsum'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            expected = df.groupby(['area_code', 'age_band']).rolling('%dD' % window, on='date')['cases'].sum()
+            seconds['pandas'].append(time.perf_counter() - start)
+
+        # the frame is sorted by group and date, which is also the order groupby().rolling() returns
+        assert np.array_equal(rolled.to_numpy(), expected.to_numpy())
+        rows.append({'scale': scale, 'rows': len(df), 'cumsum_seconds': min(seconds['cumsum']), 'pandas_seconds': min(seconds['pandas'])})
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_rolling_window())
+
+
+# In[50]:
+
+
+# Synthetic data with the columns of the five sources, for any number of areas, age band widths and years
+RESTRICTION_COLUMNS = ['schools_closed', 'pubs_closed', 'shops_closed', 'eating_places_closed', 'stay_at_home_apart_exceptions',
+                       'household_mixing_indoors_banned', 'wfh', 'rule_of_6_indoors', 'curfew', 'eat_out_to_help_out']
+
+
+def synthetic_age_bands(first_age, age_band_width):
+    bands = ['%02d_%02d' % (i, i + age_band_width - 1) for i in range(first_age, 90, age_band_width)]
+    return bands + ['90+']
+
+
+def synthetic_datasets(n_areas=1, age_band_width=5, years=1.6, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-03-01', periods=int(365 * years), freq='D')
+    area_codes = ['E12000007'] + ['E09%06d' % i for i in range(1, n_areas)]
+    area_names = ['London'] + ['Borough %d' % i for i in range(1, n_areas)]
+
+    def frame(levels, names):
+        return pd.MultiIndex.from_product(levels, names=names).to_frame(index=False)
+
+    # cases: one row per area, day and age band, including the unassigned cases
+    age_bands = synthetic_age_bands(0, age_band_width) + ['unassigned']
+    cases_by_age = frame([range(n_areas), dates, age_bands], ['area', 'date', 'age_band'])
+    cases_by_age.insert(0, 'area_code', np.asarray(area_codes)[cases_by_age.pop('area')])
+    cases_by_age.insert(1, 'area_name', cases_by_age['area_code'].map(dict(zip(area_codes, area_names))))
+    cases_by_age['cases'] = rng.poisson(50, len(cases_by_age))
+    cases_by_age['rolling_sum'] = rolling_window(cases_by_age, 'date', 'cases', ['area_code', 'age_band'], window=7)
+    population = rng.integers(50000, 700000, (n_areas, 1, len(age_bands)))
+    cases_by_age['population'] = np.broadcast_to(population, (n_areas, len(dates), len(age_bands))).ravel()
+
+    # vaccines: cumulative doses from the first jab, by dose and age band from 18
+    vaccine_dates = dates[dates >= '2020-12-08']
+    vaccines_by_age = frame([range(n_areas), vaccine_dates, ['First', 'Second'], ['18_24'] + synthetic_age_bands(25, age_band_width)],
+                            ['area', 'date', 'dose', 'age_band'])
+    vaccines_by_age.insert(0, 'area_code', np.asarray(area_codes)[vaccines_by_age.pop('area')])
+    vaccines_by_age.insert(1, 'area_name', vaccines_by_age['area_code'].map(dict(zip(area_codes, area_names))))
+    vaccines_by_age['new_doses'] = rng.poisson(200, len(vaccines_by_age))
+    vaccines_by_age['cum_doses'] = vaccines_by_age.groupby(['area_code', 'dose', 'age_band'])['new_doses'].cumsum()
+    vaccines_by_age['population'] = rng.integers(50000, 700000, len(vaccines_by_age))
+
+    # admissions: weekly, for London only
+    week_ending = pd.date_range(dates[0] + pd.Timedelta(days=21), dates[-1], freq='W-SUN')
+    admissions_by_age = frame([week_ending, ['0_to_5', '6_to_17', '18_to_64', '65_to_84', '85+']], ['week_ending', 'age'])
+    admissions_by_age.insert(0, 'area_name', 'London')
+    admissions_by_age['weekly_admissions'] = rng.poisson(80, len(admissions_by_age))
+
+    restrictions = pd.DataFrame({'date': dates})
+    for column in RESTRICTION_COLUMNS:
+        restrictions[column] = (rng.random(len(dates)) < 0.3).astype(int)
+
+    testing = pd.DataFrame({'areaName': 'London', 'date': dates[::-1],
+                            'uniquePeopleTestedBySpecimenDateRollingSum': rng.integers(100000, 500000, len(dates))})
+
+    frames = {'cases_by_age': cases_by_age, 'vaccines_by_age': vaccines_by_age, 'admissions_by_age': admissions_by_age,
+              'restrictions': restrictions, 'testing': testing}
+    return Datasets(load_seconds={}, **{name: apply_schema(df, SOURCE_SCHEMAS[name]) for name, df in frames.items()})
+
+
+def write_synthetic_csvs(datasets, directory):
+    # one file per source, named as the source url, e.g. to be served by a local HTTP server
+    os.makedirs(directory, exist_ok=True)
+    for name, url in DATA_SOURCES.items():
+        getattr(datasets, name).to_csv(os.path.join(directory, url.split('?')[0].rsplit('/', 1)[-1]), index=False, date_format='%Y-%m-%d')
+
+
+# Every section 5 transformation and every plotting helper at growing scale, with the stage cache switched off: the
+# feeds with areas get `scale` times as many areas, the others `scale` times as many years
+def benchmark_pipeline(scales=(1, 10, 100), repeat=3):
+    rows = []
+    with stage_cache_disabled():
+        for scale in scales:
+            data = synthetic_datasets(n_areas=scale)
+            week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+            # admissions, restrictions and testing are for London only, they grow with the number of years instead
+            history = synthetic_datasets(years=1.6 * scale)
+            history_week_endings = week_ending_calendar(history.admissions_by_age['week_ending'])
+            steps = [('to_weekly_cases', to_weekly_cases, (data.cases_by_age, week_endings)),
+                     ('to_weekly_vaccines', to_weekly_vaccines, (data.vaccines_by_age, week_endings)),
+                     ('to_weekly_admissions', to_weekly_admissions, (history.admissions_by_age, history_week_endings)),
+                     ('to_weekly_restrictions', to_weekly_restrictions, (history.restrictions, history_week_endings)),
+                     ('to_weekly_testing', to_weekly_testing, (history.testing, history_week_endings)),
+                     ('one_variable_figure', one_variable_figure, (data.cases_by_age, 'date', 'cases', '', '', '')),
+                     ('two_variable_stacked_figure', two_variable_stacked_figure, (data.vaccines_by_age, 'date', 'cum_doses', 'age_band', '', '', '')),
+                     ('two_variable_grouped_figure', two_variable_grouped_figure, (data.vaccines_by_age, 'age_band', 'new_doses', 'dose', '', '', '')),
+                     ('multi_value_stacked_figure', multi_value_stacked_figure, (history.restrictions, 'date', '', '', ''))]
+            for name, function, args in steps:
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    function(*args)
+                    seconds.append(time.perf_counter() - start)
+                rows.append({'scale': scale, 'step': name, 'rows': len(args[0]), 'seconds': min(seconds),
+                             'rows_per_second': len(args[0]) / min(seconds)})
+    return pd.DataFrame(rows).pivot(index='step', columns='scale')
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_pipeline())
+
+
+# In[51]:
+
+
+# Parsing a cases file with the London boroughs: everything, only the columns used in section 5, and those columns on
+# the week ending dates. The file is made from synthetic data, so that no download is needed.
+def benchmark_pushdown(n_areas=33, repeat=3):
+    data = synthetic_datasets(n_areas=n_areas)
+    body = data.cases_by_age.to_csv(index=False, date_format='%Y-%m-%d').encode('utf-8')
+    week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+    columns = ['date', 'age_band', 'rolling_sum', 'population']
+
+    rows = []
+    for name, kwargs in [('all columns', {}), ('projected', {'columns': columns}),
+                         ('projected + week endings', {'columns': columns, 'where': {'date': list(week_endings)}})]:
+        seconds = []
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            df = read_csv_filtered(io.BytesIO(body), parse_dates=['date'], **kwargs)
+            seconds.append(time.perf_counter() - start)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        rows.append({'read': name, 'rows': len(df), 'columns': df.shape[1], 'seconds': min(seconds), 'peak_mb': peak / 2**20})
+    return pd.DataFrame(rows).set_index('read')
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_pushdown())
+
+
+# In[52]:
+
+
+# Payload size and render time of a stacked chart of the daily cases by age band, before and after downsampling
+def benchmark_downsampling(years=(1.6, 10, 40), max_points=(None, 2000, 500), methods=('lttb', 'minmax')):
+    import plotly.io as pio
+
+    rows = []
+    for n_years in years:
+        data = synthetic_datasets(years=n_years)
+        for points in max_points:
+            for method in (methods if points else methods[:1]):
+                start = time.perf_counter()
+                fig = two_variable_stacked_figure(data.cases_by_age, 'date', 'cases', 'age_band', '', '', '')
+                fig = downsample_figure(fig, max_points=points, method=method)
+                build_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                html = pio.to_html(fig, include_plotlyjs=False)
+                rows.append({'years': n_years, 'max_points': points or 'all', 'method': method if points else '',
+                             'points_per_trace': len(fig.data[0].x), 'payload_mb': len(html) / 2**20,
+                             'build_seconds': build_seconds, 'render_seconds': time.perf_counter() - start})
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_downsampling())
+
+
+# In[53]:
+
+
+# Per-borough weekly cases and vaccines: one grouped pass against the partitions in a process pool, for growing numbers of workers
+def benchmark_by_area(n_areas=(8, 33, 100), workers=(1, 2, 4, 8), repeat=3):
+    rows = []
+    with stage_cache_disabled():
+        for areas in n_areas:
+            data = synthetic_datasets(n_areas=areas)
+            week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+            for name, transform, df in (('cases', to_weekly_cases, data.cases_by_age), ('vaccines', to_weekly_vaccines, data.vaccines_by_age)):
+                runs = [('grouped', 1, lambda: transform(df, week_endings, area_column_names=['area_code']))]
+                runs += [('pool', n, lambda n=n: by_area(transform, df, workers=n, week_endings=week_endings)) for n in workers]
+                for method, n, run in runs:
+                    seconds = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        run()
+                        seconds.append(time.perf_counter() - start)
+                    rows.append({'areas': areas, 'table': name, 'method': method, 'workers': n, 'rows': len(df), 'seconds': min(seconds)})
+    print('Cores:', os.cpu_count())
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_by_area())
+
+
+# In[54]:
+
+
+# The weekly cases of the 70+ in the first half of 2021, per area: recomputed from the daily cases, or read from the store
+def benchmark_store(n_areas=(1, 33, 100), repeat=3, path=os.path.join(CACHE_DIR, 'benchmark.sqlite')):
+    where = {'age_band': ['70+ years'], 'date': ('2021-01-01', '2021-06-30')}
+
+    rows = []
+    try:
+        with stage_cache_disabled():
+            for areas in n_areas:
+                data = synthetic_datasets(n_areas=areas)
+                week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+                weekly_cases = to_weekly_cases(data.cases_by_age, week_endings, area_column_names=['area_code'])
+                start = time.perf_counter()
+                write_store({'weekly_cases_by_borough': weekly_cases}, path)
+                write_seconds = time.perf_counter() - start
+
+                def recompute():
+                    df = to_weekly_cases(data.cases_by_age, week_endings, area_column_names=['area_code'])
+                    return df[row_filter(df, {'age_band': where['age_band'], 'date': tuple(pd.Timestamp(i) for i in where['date'])})]
+
+                for method, run in (('recompute', recompute), ('query', lambda: query_store('weekly_cases_by_borough', where=where, path=path))):
+                    seconds = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        df = run()
+                        seconds.append(time.perf_counter() - start)
+                    rows.append({'areas': areas, 'method': method, 'rows': len(df), 'seconds': min(seconds), 'write_seconds': write_seconds})
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_store())
+
+
+# In[55]:
+
+
+# Rolling-origin backtests of the forecasting models for growing numbers of series (areas x 5 age bands):
+# all series at once, one series at a time, and all series at once with the origins in a process pool
+def benchmark_forecasting(n_areas=(1, 33, 100), workers=2):
+    rows = []
+    with stage_cache_disabled():
+        for areas in n_areas:
+            data = synthetic_datasets(n_areas=areas, years=3)
+            week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+            weekly_cases = to_weekly_cases(data.cases_by_age, week_endings, area_column_names=['area_code'])
+            values = weekly_cases.set_index(['date', 'area_code', 'age_band'])['weekly_cases'].unstack(['area_code', 'age_band']).to_numpy('float64')
+            weekly_flags = to_weekly_restrictions(data.restrictions, week_endings).set_index('date')
+            exog = weekly_flags.reindex(np.unique(weekly_cases['date'])).fillna(0).to_numpy('float64')
+
+            runs = [('batched', lambda: rolling_origin_backtest(values, exog)),
+                    ('per_series', lambda: [rolling_origin_backtest(values[:, [i]], exog) for i in range(values.shape[1])]),
+                    ('batched_pool', lambda: rolling_origin_backtest(values, exog, workers=workers))]
+            for method, run in runs:
+                start = time.perf_counter()
+                run()
+                rows.append({'series': values.shape[1], 'method': method, 'seconds': time.perf_counter() - start})
+    return pd.DataFrame(rows).pivot(index='series', columns='method', values='seconds')
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_forecasting())
+
+
+# In[56]:
+
+
+# Scenario simulation for growing numbers of samples and scenarios: time and peak memory by chunk size and workers
+def benchmark_scenarios(n_samples=(1000, 10000, 50000), n_scenarios=(4, 32), chunk_samples=(1000, 10000), workers=(1, 2)):
+    with stage_cache_disabled():
+        data = synthetic_datasets()
+        week_endings = week_ending_calendar(data.admissions_by_age['week_ending'])
+        weekly_cases = to_weekly_cases(data.cases_by_age, week_endings).set_index(['date', 'age_band'])['weekly_cases'].unstack('age_band')
+        flags = to_weekly_restrictions(data.restrictions, week_endings).set_index('date').reindex(weekly_cases.index).fillna(0)
+        model = fit_scenario_model(weekly_cases.to_numpy('float64'), flags.to_numpy('float64'))
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for scenarios in n_scenarios:
+        schedules = (rng.random((scenarios, SCENARIO_WEEKS, flags.shape[1])) < 0.5).astype('float64')
+        for samples in n_samples:
+            for chunk in chunk_samples:
+                for n in workers:
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    simulate_scenarios(model, schedules, samples, chunk, workers=n)
+                    seconds = time.perf_counter() - start
+                    peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+                    tracemalloc.stop()
+                    rows.append({'scenarios': scenarios, 'samples': samples, 'chunk_samples': chunk, 'workers': n, 'seconds': seconds,
+                                 'runs_per_second': scenarios * samples / seconds, 'peak_mb': peak_mb})
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_scenarios())
+
+
+# In[57]:
+
+
+# Local stand-in for the data servers: serves the files of a directory with ETags, after `latency` seconds,
+# or fails every request with `status`. Both can be changed through server.settings while it runs.
+@contextlib.contextmanager
+def stand_in_server(directory, latency=0.0, status=None):
+    settings = {'latency': latency, 'status': status}
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def do_GET(self):
+            time.sleep(settings['latency'])
+            if settings['status']:
+                self.send_error(settings['status'])
+                return
+            file_name = self.translate_path(self.path.split('?')[0])
+            if not os.path.isfile(file_name):
+                self.send_error(404)
+                return
+            with open(file_name, 'rb') as f:
+                body = f.read()
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.settings = settings
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def stand_in_sources(server, sources=DATA_SOURCES):
+    # the sources with their host replaced by the stand-in server, which serves the files of write_synthetic_csvs()
+    return {name: server.url + '/' + url.split('?')[0].rsplit('/', 1)[-1] for name, url in sources.items()}
+
+
+# The cache against a stand-in server: first download, revalidation, server errors, server down, and cache keys of
+# filters that only differ in the middle of a long array
+def check_cache():
+    data = synthetic_datasets()
+    steps = []
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_csvs(data, os.path.join(directory, 'files'))
+        cache_dir = os.path.join(directory, 'cache')
+
+        def load(step, sources, **expected):
+            before = dict(cache_stats)
+            loaded = load_datasets(sources, retries=0, cache_dir=cache_dir)
+            counts = {key: cache_stats[key] - before[key] for key in cache_stats}
+            for key, value in expected.items():
+                assert counts[key] == value, '%s: %s is %s, not %s' % (step, key, counts[key], value)
+            for name in DATA_SOURCES:
+                pd.testing.assert_frame_equal(getattr(loaded, name), getattr(data, name), check_dtype=False, check_categorical=False)
+            steps.append(dict(step=step, **counts))
+
+        with stand_in_server(os.path.join(directory, 'files')) as server:
+            sources = stand_in_sources(server)
+            load('first load', sources, misses=5, hits=0)
+            load('unchanged', sources, hits=5, misses=0, bytes_downloaded=0)
+            server.settings['status'] = 503
+            load('server error', sources, offline_hits=5, misses=0)
+        load('server down', sources, offline_hits=5, misses=0)
+
+    where = np.arange(10000)
+    other = where.copy()
+    other[5000] = -1
+    assert cache_paths('url', where={'cases': where}) != cache_paths('url', where={'cases': other})
+    return pd.DataFrame(steps)
+
+
+if RUN_BENCHMARKS:
+    print(check_cache())
+
+
+# In[58]:
+
+
+# Concurrent loading against a stand-in server that answers every request after `latency` seconds: the five sources
+# should take about as long as the slowest one, not the sum of all five
+def check_concurrent_load(latency=1.0, repeat=3):
+    data = synthetic_datasets()
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        write_synthetic_csvs(data, directory)
+        with stand_in_server(directory, latency=latency) as server:
+            for run in range(repeat):
+                # a new cache every time, so that every source is downloaded and parsed
+                start = time.perf_counter()
+                loaded = load_datasets(stand_in_sources(server), retries=0, cache_dir=os.path.join(directory, 'cache_%d' % run))
+                rows.append({'run': run, 'seconds': time.perf_counter() - start, 'slowest_source': max(loaded.load_seconds.values()),
+                             'sum_of_sources': sum(loaded.load_seconds.values())})
+
+    df = pd.DataFrame(rows)
+    assert df['seconds'].min() < 2 * latency, 'loading took %.2f s, more than twice the latency of one source' % df['seconds'].min()
+    return df
+
+
+if RUN_BENCHMARKS:
+    print(check_concurrent_load())
+
+
 # In[ ]:
 
 
@@ -0,0 +1,171 @@
+"""Run selected sections of Python-CW.py from the command line.
+
+    python cli.py fetch                      download the datasets into the cache
+    python cli.py transform [--sections 5]   build the weekly tables, without charts
+    python cli.py plot [--sections 4 5]      write the charts to HTML and JSON files
+    python cli.py report [--sections 4 5 7]  print the outputs of the cells, without charts
+    python cli.py startup                    cold start time of each subcommand
+
+The notebook is split into its cells, and only the cells of the selected sections are run, together with the sections
+they use: section 3, which loads the data and defines the functions, always runs, section 7 uses the weekly tables of
+section 5, and the benchmarks of section 9 use both. Selecting section 9 also runs the benchmarks. Whatever the
+sections, the batch rendering and profiling report cells run last, to write out the charts and profiles of the cells
+before them. Only the standard library is imported here; numpy and pandas are imported by the notebook cells, and
+plotly only once a chart is built.
+"""
+
+import argparse
+import ast
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+import types
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Python-CW.py')
+SETUP_SECTION = 3
+BENCHMARK_SECTION = 9
+# section: the sections whose tables or functions it uses
+SECTION_DEPENDENCIES = {7: (5,), 9: (5, 7)}
+# run after the selected cells, whatever the sections, as they write out what the cells before them queued or recorded
+FINAL_SUBSECTIONS = ('Batch rendering', 'Profiling report')
+
+# subcommand: (help, sections run by default, environment variables the notebook reads, print the cell outputs)
+SUBCOMMANDS = {
+    'fetch': ('download the datasets into the cache', (), {'SHOW_CHARTS': '0'}, True),
+    'transform': ('build the weekly tables, without charts', (5,), {'SHOW_CHARTS': '0'}, False),
+    'plot': ('write the charts to HTML and JSON files', (4, 5), {'BATCH_RENDER': '1'}, False),
+    'report': ('print the outputs of the cells, without charts', (4, 5, 7), {'SHOW_CHARTS': '0'}, True),
+}
+
+Cell = types.SimpleNamespace
+
+
+def notebook_cells(path=NOTEBOOK):
+    # cells start at the '# In[N]:' lines, and belong to the last '# ### N.' section and '# #####' subsection headings
+    # above them
+    with open(path) as f:
+        lines = f.read().splitlines(keepends=True)
+
+    cells, section, subsection = [], 0, None
+    for number, line in enumerate(lines):
+        heading = re.match(r'# ### (\d+)\s*\.', line)
+        subheading = re.match(r'# ##### (.+)', line)
+        if heading:
+            section, subsection = int(heading.group(1)), None
+        elif subheading:
+            subsection = subheading.group(1).strip()
+        elif re.match(r'# In\[[\d ]*\]:', line):
+            cells.append(Cell(section=section, subsection=subsection, name=line[2:].strip().rstrip(':'), first_line=number, source=[]))
+        if cells:
+            cells[-1].source.append(line)
+    return [cell for cell in cells if ''.join(cell.source).strip()]
+
+
+def run_cell(cell, namespace, display=False, path=NOTEBOOK):
+    # padded with empty lines, so that tracebacks point at the lines of the notebook
+    tree = ast.parse('\n' * cell.first_line + ''.join(cell.source), path)
+    last = tree.body.pop() if display and tree.body and isinstance(tree.body[-1], ast.Expr) else None
+    exec(compile(tree, path, 'exec'), namespace)
+    if last is not None:
+        value = eval(compile(ast.Expression(last.value), path, 'eval'), namespace)
+        if value is not None:
+            print('%s:' % cell.name.replace('In', 'Out'))
+            print(value)
+
+
+def with_dependencies(sections):
+    sections, pending = set(sections), list(sections)
+    while pending:
+        for section in SECTION_DEPENDENCIES.get(pending.pop(), ()):
+            if section not in sections:
+                sections.add(section)
+                pending.append(section)
+    return sections
+
+
+def run(subcommand, sections=None, path=NOTEBOOK):
+    _, default_sections, environment, display = SUBCOMMANDS[subcommand]
+    sections = with_dependencies(default_sections if sections is None else sections) | {SETUP_SECTION}
+    if BENCHMARK_SECTION in sections:
+        environment = dict(environment, RUN_BENCHMARKS='1')
+
+    # The cells run as the __main__ module, as in the notebook, so that the process pools some of them opt into can
+    # find their functions. The module has no __file__, so that workers started with spawn or forkserver don't run the
+    # notebook again; the pools are forked instead, and the benchmarks, which use them, need fork.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('fork', force=True)
+    elif BENCHMARK_SECTION in sections:
+        raise SystemExit('the benchmarks of section %d need the fork start method of multiprocessing' % BENCHMARK_SECTION)
+    os.environ.update(environment)
+
+    module = types.ModuleType('__main__')
+    sys.modules['__main__'] = module
+    cells = notebook_cells(path)
+    final = [cell for cell in cells if cell.subsection in FINAL_SUBSECTIONS]
+    for cell in [cell for cell in cells if cell.section in sections and cell not in final] + final:
+        run_cell(cell, module.__dict__, display, path)
+
+
+def import_seconds(importtime_output):
+    # total of the top level imports in the output of python -X importtime, and the share of the heavy packages
+    total, heavy = 0, {}
+    for line in importtime_output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            total += int(match.group(1))
+            package = match.group(2).split('.')[0]
+            if package in ('numpy', 'pandas', 'plotly'):
+                heavy[package] = heavy.get(package, 0) + int(match.group(1)) / 1e6
+    return total / 1e6, heavy
+
+
+def startup(subcommands=None, repeat=3):
+    # each subcommand in a new interpreter, against --help for the interpreter and argparse alone;
+    # the best of `repeat` runs, after a first run that fills the data cache
+    rows = []
+    for subcommand in ['--help'] + list(subcommands or SUBCOMMANDS):
+        command = [sys.executable, '-X', 'importtime', os.path.abspath(__file__), subcommand]
+        subprocess.run(command, capture_output=True, text=True)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run(command, capture_output=True, text=True)
+            seconds = time.perf_counter() - start
+            if result.returncode:
+                raise RuntimeError('%s failed:\n%s' % (subcommand, result.stderr[-2000:]))
+            if best is None or seconds < best[0]:
+                best = (seconds,) + import_seconds(result.stderr)
+        rows.append((subcommand,) + best)
+
+    print('%-10s %9s %9s  %s' % ('command', 'seconds', 'imports', 'of which (seconds)'))
+    for subcommand, seconds, imports, heavy in rows:
+        print('%-10s %9.2f %9.2f  %s' % (subcommand, seconds, imports, ', '.join('%s %.2f' % i for i in heavy.items()) or '-'))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='subcommand', required=True)
+    for subcommand, (description, default_sections, _, _) in SUBCOMMANDS.items():
+        command = commands.add_parser(subcommand, help=description)
+        command.add_argument('--sections', type=int, nargs='*',
+                             help='sections of the notebook to run after section 3 (default: %s)' % (list(default_sections) or 'none'))
+    command = commands.add_parser('startup', help='cold start time of each subcommand')
+    command.add_argument('subcommands', nargs='*', metavar='subcommand', help='one of %s (default: all)' % ', '.join(SUBCOMMANDS))
+    command.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args(argv)
+    if args.subcommand == 'startup':
+        unknown = set(args.subcommands) - set(SUBCOMMANDS)
+        if unknown:
+            parser.error('unknown subcommands: %s' % ', '.join(sorted(unknown)))
+        startup(args.subcommands, args.repeat)
+    else:
+        run(args.subcommand, args.sections)
+
+
+if __name__ == '__main__':
+    main()